@@ -1,24 +1,328 @@
 #!/usr/bin/python3
-from subprocess import check_output
-import os
+"""Print the history of the labeling application status of ICOS stations.
 
+Status changes are read from the labeling table of the RDF log database,
+and joined with the IDs and names of the stations from the station entry
+metadata. The database is given as a PostgreSQL connection string, e.g.
+postgresql://postgres@localhost:5433/postgres through an SSH tunnel
+(ssh -L 5433:localhost:5432 fsicos.lunarc.lu.se), or as the path to an
+SQLite database with the same labeling table.
 
-sparql_query_file = os.path.join(os.getcwd(), 'sparql-query.txt')
-sparql_result = check_output(sparql_query_file, shell=True)
-lookup = {}
+With --state-file, status changes are kept in a local SQLite database
+along with the timestamp of the latest one, so that later runs only fetch
+the status changes logged since then.
+"""
 
-for line in sparql_result.splitlines():
-	line_decoded = line.decode("utf-8")
-	if not line_decoded == 's,id,name':
-		url, id, name = line_decoded.split(',')
-		lookup[url] = (id, name)
+import io
+import csv
+import sys
+import json
+import sqlite3
+import argparse
+import urllib.parse
+import urllib.request
+from collections import deque
+from contextlib import contextmanager
+from itertools import groupby
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Iterator, Optional, TextIO, Tuple
 
+SPARQL_ENDPOINT = "https://meta.icos-cp.eu/sparql"
+STATIONS_QUERY_FILE = Path(__file__).parent / "stations-query.rq"
+RDF_QUERY_FILE = Path(__file__).parent / "rdf-query.sql"
+# Number of rows fetched at a time from the database.
+FETCH_SIZE = 2000
+OUTPUT_FORMATS = ("csv", "json")
+COLUMNS = ("date", "id", "name", "status")
+# Statuses of the first labeling step were logged without step prefix.
+STATUS_REMAPPING = {
+	"SUBMITTED": "STEP1SUBMITTED",
+	"ACKNOWLEDGED": "STEP1ACKNOWLEDGED",
+	"APPROVED": "STEP1APPROVED"
+}
+# Orders of the status changes fetched from the database: by station for
+# reports, by time for updates of the local state.
+STATION_ORDER = '"SUBJECT", tstamp'
+TIME_ORDER = 'tstamp, "SUBJECT"'
 
-rdf_query_file = os.path.join(os.getcwd(), 'rdf-query.sql')
-rdf_log = check_output("ssh fsicos.lunarc.lu.se docker exec -i rdflogdb-v9.6 psql -U postgres -A -F ',' -t -d postgres < " + rdf_query_file, shell=True)
 
-for line in rdf_log.splitlines():
-	date, url, status = line.decode("utf-8").split(',')
+class ConnectionPool:
+	"""Pool of connections to the RDF log database.
 
-	if url in lookup:
-		print (','.join((date, lookup[url][0], lookup[url][1], status)))
+	PostgreSQL connection strings are handled by psycopg2's connection pool,
+	anything else is taken as the path to an SQLite database.
+	"""
+
+	def __init__(self, database: str, max_connections: int = 2):
+		self.database = database
+		self.is_postgres = database.startswith(("postgres://", "postgresql://")) or "dbname=" in database
+		if self.is_postgres:
+			pool = require_psycopg2_pool()
+			self._pool = pool.SimpleConnectionPool(1, max_connections, database)
+		else:
+			self._connections: list[sqlite3.Connection] = []
+
+	@contextmanager
+	def connection(self) -> Iterator[Any]:
+		if self.is_postgres:
+			conn = self._pool.getconn()
+			try:
+				yield conn
+			finally:
+				self._pool.putconn(conn)
+		else:
+			conn = self._connections.pop() if self._connections else sqlite3.connect(self.database)
+			try:
+				yield conn
+			finally:
+				self._connections.append(conn)
+
+	def placeholder(self, name: str) -> str:
+		"""Named query parameter in the syntax of the database driver."""
+
+		return f"%({name})s" if self.is_postgres else f":{name}"
+
+	def stream(self, query: str, parameters: Optional[dict[str, Any]] = None, fetch_size: int = FETCH_SIZE) -> Iterator[Tuple[Any, ...]]:
+		"""Run a query and yield its rows, fetching them by batches.
+
+		With PostgreSQL, a named (server-side) cursor is used so that the result
+		is not loaded into memory at once; SQLite cursors already step through
+		the result lazily.
+		"""
+
+		with self.connection() as conn:
+			if self.is_postgres:
+				cursor = conn.cursor(name="labeling_status")
+				cursor.itersize = fetch_size
+			else:
+				cursor = conn.cursor()
+			try:
+				cursor.execute(query, parameters or {})
+				while True:
+					rows = cursor.fetchmany(fetch_size)
+					if len(rows) == 0:
+						break
+					yield from rows
+			finally:
+				cursor.close()
+				if self.is_postgres:
+					conn.rollback()
+
+	def close(self) -> None:
+		if self.is_postgres:
+			self._pool.closeall()
+		else:
+			for conn in self._connections:
+				conn.close()
+			self._connections.clear()
+
+
+class StatusStore:
+	"""Local SQLite copy of the labeling status changes.
+
+	The history table holds every status change, with first-step statuses
+	remapped (see STATUS_REMAPPING); the current table holds the latest
+	status of each station. The high-water mark is the timestamp of the
+	latest status change stored. Status changes are fetched again from the
+	high-water mark included, since others may have been logged with the
+	same timestamp, and duplicates are ignored.
+
+	Parameters
+	----------
+	path : str
+		Path to the SQLite file.
+	"""
+
+	def __init__(self, path: str):
+		self.conn = sqlite3.connect(path)
+		self.conn.executescript("""
+			CREATE TABLE IF NOT EXISTS status_history (
+				subject TEXT NOT NULL, tstamp TEXT NOT NULL, status TEXT NOT NULL,
+				UNIQUE (subject, tstamp, status)
+			);
+			CREATE TABLE IF NOT EXISTS current_status (
+				subject TEXT PRIMARY KEY, tstamp TEXT NOT NULL, status TEXT NOT NULL
+			);
+			CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+		""")
+
+	def high_water_mark(self) -> Optional[str]:
+		row = self.conn.execute("SELECT value FROM state WHERE key = 'high_water_mark'").fetchone()
+		return None if row is None else row[0]
+
+	def update(self, rows: Iterator[Tuple[Any, ...]]) -> int:
+		"""Store status changes (timestamp, station URI, status) given in timestamp order.
+
+		Returns
+		-------
+		The number of status changes that were not stored yet.
+		"""
+
+		high_water_mark = self.high_water_mark()
+		n_new = 0
+		with self.conn:
+			for date, subject, status in remap_statuses(rows):
+				tstamp = format_date(date)
+				cursor = self.conn.execute(
+					"INSERT OR IGNORE INTO status_history (subject, tstamp, status) VALUES (?, ?, ?)",
+					(subject, tstamp, status)
+				)
+				if cursor.rowcount == 0:
+					continue
+				n_new += 1
+				self.conn.execute(
+					"""INSERT INTO current_status (subject, tstamp, status) VALUES (?, ?, ?)
+					ON CONFLICT (subject) DO UPDATE SET tstamp = excluded.tstamp, status = excluded.status
+					WHERE excluded.tstamp >= current_status.tstamp""",
+					(subject, tstamp, status)
+				)
+				high_water_mark = tstamp
+			if high_water_mark is not None:
+				self.conn.execute(
+					"INSERT INTO state (key, value) VALUES ('high_water_mark', ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+					(high_water_mark,)
+				)
+		return n_new
+
+	def history(self) -> Iterator[Tuple[str, str, str]]:
+		yield from self.conn.execute("SELECT tstamp, subject, status FROM status_history ORDER BY subject, tstamp, rowid")
+
+	def current(self) -> Iterator[Tuple[str, str, str]]:
+		yield from self.conn.execute("SELECT tstamp, subject, status FROM current_status ORDER BY subject")
+
+	def close(self) -> None:
+		self.conn.close()
+
+
+def fetch_status_changes(
+		pool: ConnectionPool,
+		since: Optional[str] = None,
+		order_by: str = TIME_ORDER,
+		fetch_size: int = FETCH_SIZE) -> Iterator[Tuple[Any, ...]]:
+	"""Yield the status changes logged at or after a timestamp (all of them if None)."""
+
+	query = RDF_QUERY_FILE.read_text().format(since=pool.placeholder("since"), order_by=order_by)
+	return pool.stream(query, {"since": since}, fetch_size)
+
+
+def remap_statuses(rows: Iterator[Tuple[Any, ...]]) -> Iterator[Tuple[Any, ...]]:
+	for date, subject, status in rows:
+		yield date, subject, STATUS_REMAPPING.get(status, status)
+
+
+def latest_statuses(rows: Iterator[Tuple[Any, ...]]) -> Iterator[Tuple[Any, ...]]:
+	"""Keep the last status change of each station from status changes ordered by station and time."""
+
+	for _, station_rows in groupby(rows, key=lambda row: row[1]):
+		yield deque(station_rows, maxlen=1)[0]
+
+
+def require_psycopg2_pool() -> Any:
+	try:
+		from psycopg2 import pool
+	except ImportError:
+		raise ImportError("PostgreSQL databases require the psycopg2 package; install it or use an SQLite database.") from None
+	return pool
+
+
+def read_station_lookup(lines: Iterator[str]) -> dict[str, Tuple[str, str]]:
+	"""Parse the CSV result of the stations query into a station URI to (ID, name) mapping."""
+
+	return {row["s"]: (row["id"], row["name"]) for row in csv.DictReader(lines)}
+
+
+def fetch_station_lookup(query: str, endpoint: str = SPARQL_ENDPOINT) -> dict[str, Tuple[str, str]]:
+	url = f"{endpoint}?{urllib.parse.urlencode({'query': query})}"
+	request = urllib.request.Request(url, headers={"Accept": "text/csv"})
+	with urllib.request.urlopen(request) as response:
+		return read_station_lookup(io.TextIOWrapper(response, encoding="utf-8", newline=""))
+
+
+def labeling_status(rows: Iterator[Tuple[Any, ...]], lookup: dict[str, Tuple[str, str]]) -> Iterator[Tuple[str, str, str, str]]:
+	"""Join status changes (timestamp, station URI, status) with the station lookup.
+
+	Status changes of stations that are not in the lookup are skipped.
+	"""
+
+	for date, url, status in rows:
+		if url in lookup:
+			station_id, name = lookup[url]
+			yield format_date(date), station_id, name, status
+
+
+def format_date(date: Any) -> str:
+	return date.isoformat(sep=" ") if isinstance(date, datetime) else str(date)
+
+
+def write_csv(records: Iterator[Tuple[str, ...]], output: TextIO, header: bool = False) -> None:
+	writer = csv.writer(output, lineterminator="\n")
+	if header:
+		writer.writerow(COLUMNS)
+	writer.writerows(records)
+
+
+def write_json(records: Iterator[Tuple[str, ...]], output: TextIO) -> None:
+	"""Write records as a JSON array of objects, one record at a time."""
+
+	output.write("[")
+	for n, record in enumerate(records):
+		output.write(",\n" if n > 0 else "\n")
+		output.write(json.dumps(dict(zip(COLUMNS, record)), ensure_ascii=False))
+	output.write("\n]\n")
+
+
+def parse_arguments() -> argparse.Namespace:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("database", help="PostgreSQL connection string or path to an SQLite database of the RDF log.")
+	parser.add_argument("--stations-file", type=Path, help="CSV file with the result of the stations query, instead of querying the SPARQL endpoint.")
+	parser.add_argument("--endpoint", default=SPARQL_ENDPOINT, help="SPARQL endpoint of the station entry metadata.")
+	parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv", help="Output format.")
+	parser.add_argument("--header", action="store_true", help="Write a header line in CSV output.")
+	parser.add_argument("--output", type=Path, help="Output file (default: standard output).")
+	parser.add_argument("--fetch-size", type=int, default=FETCH_SIZE, help="Number of rows fetched at a time from the database.")
+	parser.add_argument("--state-file", type=Path, help="Local SQLite file keeping the status changes, so that only new ones are fetched.")
+	parser.add_argument("--current", action="store_true", help="Only report the current status of each station.")
+	return parser.parse_args()
+
+
+def main(args: argparse.Namespace, output: TextIO) -> None:
+	if args.stations_file is None:
+		lookup = fetch_station_lookup(STATIONS_QUERY_FILE.read_text(), args.endpoint)
+	else:
+		with open(args.stations_file, "r", newline="", encoding="utf-8") as file:
+			lookup = read_station_lookup(file)
+	pool = ConnectionPool(args.database)
+	if args.state_file is None:
+		# Status changes are streamed from the database to the output.
+		try:
+			rows = remap_statuses(fetch_status_changes(pool, None, STATION_ORDER, args.fetch_size))
+			write_records(labeling_status(latest_statuses(rows) if args.current else rows, lookup), args, output)
+		finally:
+			pool.close()
+		return
+	store = StatusStore(str(args.state_file))
+	try:
+		try:
+			store.update(fetch_status_changes(pool, store.high_water_mark(), TIME_ORDER, args.fetch_size))
+		finally:
+			pool.close()
+		write_records(labeling_status(store.current() if args.current else store.history(), lookup), args, output)
+	finally:
+		store.close()
+
+
+def write_records(records: Iterator[Tuple[str, ...]], args: argparse.Namespace, output: TextIO) -> None:
+	if args.format == "json":
+		write_json(records, output)
+	else:
+		write_csv(records, output, args.header)
+
+
+if __name__ == "__main__":
+	arguments = parse_arguments()
+	if arguments.output is None:
+		main(arguments, sys.stdout)
+	else:
+		with open(arguments.output, "w", newline="", encoding="utf-8") as output_file:
+			main(arguments, output_file)
@@ -0,0 +1,197 @@
+import asyncio
+import atexit
+import time
+from typing import Optional, Any, Tuple
+from urllib.parse import urlsplit
+import httpx
+from sparql import (
+	SparqlResults, SPARQL_ENDPOINT, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT,
+	parse_sparql_json, single_param_values, multi_params_values
+)
+from sparql_cache import SparqlCache
+from retry import Retrier
+
+
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+class HostRateLimiter:
+	"""Enforce a minimum interval between the starts of requests to the same host."""
+
+	def __init__(self, min_interval: float):
+		self.min_interval = min_interval
+		self._next_start: dict[str, float] = {}
+		self._locks: dict[str, asyncio.Lock] = {}
+
+	async def wait(self, host: str) -> None:
+		if self.min_interval <= 0:
+			return
+		lock = self._locks.setdefault(host, asyncio.Lock())
+		async with lock:
+			now = time.monotonic()
+			start = max(now, self._next_start.get(host, now))
+			self._next_start[host] = start + self.min_interval
+		await asyncio.sleep(start - now)
+
+
+class AsyncSparqlClient:
+	"""Asynchronous client for the ICOS Carbon Portal SPARQL endpoint.
+
+	Queries can be awaited concurrently; at most `max_concurrency` of them are
+	in flight at any time and their starts are spaced by at least `min_interval`
+	seconds per host.
+
+	Parameters
+	----------
+	endpoint : str
+		URL of the SPARQL endpoint.
+	max_concurrency : int
+		Maximum number of queries running at the same time.
+	min_interval : float
+		Minimum time in seconds between the starts of two queries to the same host.
+	connect_timeout : float
+		Timeout in seconds for establishing a connection.
+	read_timeout : float
+		Timeout in seconds for waiting on data from the server.
+	cache : SparqlCache, optional
+		Persistent cache of query results. If None, every query hits the endpoint.
+	retrier : Retrier, optional
+		Retries of the queries failing because of a transient error. Defaults to Retrier().
+	"""
+
+	def __init__(
+			self,
+			endpoint: str = SPARQL_ENDPOINT,
+			max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+			min_interval: float = 0.0,
+			connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+			read_timeout: float = DEFAULT_READ_TIMEOUT,
+			cache: Optional[SparqlCache] = None,
+			retrier: Optional[Retrier] = None):
+		self.endpoint = endpoint
+		self.cache = cache
+		self.retrier = Retrier() if retrier is None else retrier
+		self._host = urlsplit(endpoint).netloc
+		self._semaphore = asyncio.Semaphore(max_concurrency)
+		self._rate_limiter = HostRateLimiter(min_interval)
+		self._http = httpx.AsyncClient(
+			timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+			limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+			headers={"Accept": "application/sparql-results+json", "Accept-Encoding": "gzip, deflate"}
+		)
+
+	async def __aenter__(self) -> "AsyncSparqlClient":
+		return self
+
+	async def __aexit__(self, *exc_info: Any) -> None:
+		await self.close()
+
+	async def select(self, query: str, kind: str = "default") -> SparqlResults:
+		"""Run a SPARQL SELECT query.
+
+		Returns
+		-------
+			The results of the query in the form of a SparqlResults object containing
+			the list of parameters and the list of bindings.
+			If the HTTP response's status code is not 200 after all retries, raises an HTTPStatusError.
+		"""
+
+		cached = self.cache.get(query, kind) if self.cache is not None else None
+		if cached is not None:
+			return parse_sparql_json(cached)
+		resp = await self.retrier.call_async(lambda: self.get(query), "SPARQL query")
+		if self.cache is not None:
+			self.cache.put(query, kind, resp.text)
+		return parse_sparql_json(resp.text)
+
+	async def get(self, query: str) -> httpx.Response:
+		async with self._semaphore:
+			await self._rate_limiter.wait(self._host)
+			resp = await self._http.get(self.endpoint, params={"query": query})
+		if resp.status_code != 200:
+			raise httpx.HTTPStatusError(
+				f"Error {resp.status_code} when running SPARQL query\n{query}\n"
+				f"at SPARQL endpoint {self.endpoint}.\nReason: {resp.reason_phrase}",
+				request=resp.request, response=resp
+			)
+		return resp
+
+	async def close(self) -> None:
+		await self._http.aclose()
+
+
+async def run_sparql_select_query_async(query: str, client: AsyncSparqlClient, kind: str="default") -> Optional[SparqlResults]:
+	return await client.select(query, kind)
+
+
+async def run_sparql_select_query_single_param_async(query: str, client: AsyncSparqlClient, result_type: Optional[type]=None, kind: str="default") -> list[Any]:
+	return single_param_values(await client.select(query, kind), query, result_type)
+
+
+async def run_sparql_select_query_multi_params_async(query: str, client: AsyncSparqlClient, result_type: Optional[type]=None, kind: str="default") -> Optional[dict[str, list[str | int | float]]]:
+	return multi_params_values(await client.select(query, kind), query, result_type)
+
+
+def run_sparql_select_queries_concurrently(
+		queries: list[str],
+		kind: str = "default",
+		max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+		min_interval: float = 0.0,
+		cache: Optional[SparqlCache] = None,
+		retrier: Optional[Retrier] = None,
+		endpoint: str = SPARQL_ENDPOINT) -> list[Optional[dict[str, list[str | int | float]]]]:
+	"""Run several multi-parameter SPARQL SELECT queries concurrently from synchronous code.
+
+	Successive calls with the same settings share an event loop and a client,
+	so that connections are reused and requests are spaced across calls.
+
+	Returns
+	-------
+	The results of the queries, in the same order as the queries.
+	"""
+
+	runner, client = shared_async_client(endpoint, max_concurrency, min_interval, cache, retrier)
+
+	async def run_all() -> list[Optional[dict[str, list[str | int | float]]]]:
+		return await asyncio.gather(*[
+			run_sparql_select_query_multi_params_async(query, client, kind=kind) for query in queries
+		])
+
+	return runner.run(run_all())
+
+
+_runner: Optional[asyncio.Runner] = None
+_shared_client: Optional[AsyncSparqlClient] = None
+_shared_settings: Optional[Tuple[Any, ...]] = None
+
+
+def shared_async_client(
+		endpoint: str,
+		max_concurrency: int,
+		min_interval: float,
+		cache: Optional[SparqlCache],
+		retrier: Optional[Retrier]) -> Tuple[asyncio.Runner, AsyncSparqlClient]:
+	"""Return the module-level event loop runner and the client running on it,
+	replacing the client if the settings changed."""
+
+	global _runner, _shared_client, _shared_settings
+	if _runner is None:
+		_runner = asyncio.Runner()
+		atexit.register(close_shared_client)
+	settings = (endpoint, max_concurrency, min_interval, id(cache), id(retrier))
+	if _shared_client is None or settings != _shared_settings:
+		if _shared_client is not None:
+			_runner.run(_shared_client.close())
+		_shared_client = AsyncSparqlClient(endpoint, max_concurrency, min_interval, cache=cache, retrier=retrier)
+		_shared_settings = settings
+	return _runner, _shared_client
+
+
+def close_shared_client() -> None:
+	global _runner, _shared_client, _shared_settings
+	if _runner is None:
+		return
+	if _shared_client is not None:
+		_runner.run(_shared_client.close())
+	_runner.close()
+	_runner, _shared_client, _shared_settings = None, None, None
@@ -1,88 +1,143 @@
 #!/usr/bin/python3
 
 import sys
+import csv
 import json
+import argparse
 from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional
+from wdcgg_json import to_json_value, write_json_array
 
-# Dictionary to update before running the script by comparing the organization metadata
-# produced by the main script with the list of organization available at:
+# Table to update before each delivery by comparing the organization metadata
+# produced by the main script with the list of organizations available at:
 # https://gaw.kishou.go.jp/documents/db_list/organization
-# For organizations that are not included in the WDCGG list, start with a higher value than
-# the highest one already in use in the list.
-ORGANIZATION_CODE_CONVERSION = {
-	'1': '54',
-	'2': '177',
-	'3': '37',
-	'4': '19',
-	'5': '178',
-	'6': '157',
-	'7': '179',
-	'8': '3',
-	'9': '180',
-	'10': '181',
-	'11': '24',
-	'12': '182',
-	'13': '183',
-	'14': '25',
-	'15': '64',
-	'16': '45',
-	'17': '77',
-	'18': '184',
-	'19': '185',
-	'20': '186',
-	'21': '187',
-	'22': '71',
-	'23': '188',
-	'24': '189'
-}
+# For organizations that are not included in the WDCGG list, use codes starting
+# from a higher value than the highest one already in use in the list.
+ORGANIZATION_CODES_FILE = Path(__file__).parent / "organization_codes.csv"
+# Known contact errors in ICOS metadata, with the source of each correction.
+CONTACT_CORRECTIONS_FILE = Path(__file__).parent / "contact_corrections.csv"
 
 # Code of the first organization that is not included in the WDCGG list (see link above).
 FIRST_NEW_ORGANIZATION_CODE = 177
 
-# Known contact errors in ICOS metadata.
-CONTACT_CORRECTIONS: dict[str, dict[str, str]] = {
-	"ps_email": {
-		# The following email corrections were mentioned by Okajima Shingo
-		# in four different emails on 2024-09-25.
-		"j.m.pichon@opgc.fr": "pichon@opgc.univ-bpclermont.fr",
-		"crl@nilu.no": "chris.lunder@nilu.no",
-		"s.odoherty@bris.ac.uk": "s.odoherty@bristol.ac.uk",
-		"leuenberger@climate.unibe.ch": "markus.leuenberger@unibe.ch"
-	}
-}
-
-def correct_organizations(path_to_org_metadata: Path) -> None:
-	with open(path_to_org_metadata, "r") as original_file:
-		orgs = json.load(original_file)
-	orgs_to_keep: list[dict[str, str]] = []
-	for org in orgs:
-		new_org_code = ORGANIZATION_CODE_CONVERSION[org["or_organization_code"]]
-		if int(new_org_code) >= FIRST_NEW_ORGANIZATION_CODE:
-			org["or_organization_code"] = new_org_code
-			orgs_to_keep.append(org)
-	orgs_to_keep = sorted(orgs_to_keep, key=lambda org: (org["or_organization_code"]))
-	path_to_new_file = Path(path_to_org_metadata.parent, f"corrected_{path_to_org_metadata.name}")
-	save_content_to_file(path_to_new_file, orgs_to_keep)
-
-def correct_contacts(path_to_contact_metadata: Path) -> None:
-	with open(path_to_contact_metadata, "r") as original_file:
-		contacts = json.load(original_file)
-	for contact in contacts:
-		contact["or_organization_code"] = ORGANIZATION_CODE_CONVERSION[contact["or_organization_code"]]
-		for key, corrections in CONTACT_CORRECTIONS.items():
-			if contact[key] in corrections.keys():
-				contact[key] = corrections[contact[key]]
-	path_to_new_file = Path(path_to_contact_metadata.parent, f"corrected_{path_to_contact_metadata.name}")
-	save_content_to_file(path_to_new_file, contacts)
-
-def save_content_to_file(path_to_file: Path, content: list[dict[str, str]]) -> None:
-	save_file = "y"
-	if path_to_file.exists():
-		save_file = input(f"File {path_to_file} already exists. Overwrite? (y/n) ")
-	if save_file in ["y", "yes", "Yes"]:
-		with open(path_to_file, "w") as corrected_file:
-			json.dump(content, corrected_file)
+
+class MetadataCorrector:
+	"""Correction of the contact and organization metadata produced by the export.
+
+	Organization codes are converted to the codes of the WDCGG organization
+	list, organizations already included in this list are left out, and
+	known errors in contact metadata are corrected. Codes missing from the
+	conversion table are collected in `unmapped_codes` instead of failing:
+	organizations with such a code are left out, contacts keep it.
+
+	Parameters
+	----------
+	organization_codes : dict[str, str]
+		Organization code used by the export to code of the WDCGG organization list.
+	contact_corrections : dict[str, dict[str, str]]
+		Corrected values of contact fields, by field and wrong value.
+	first_new_organization_code : int
+		Code of the first organization that is not included in the WDCGG list.
+	"""
+
+	def __init__(
+			self,
+			organization_codes: dict[str, str],
+			contact_corrections: dict[str, dict[str, str]],
+			first_new_organization_code: int = FIRST_NEW_ORGANIZATION_CODE):
+		self.organization_codes = organization_codes
+		self.contact_corrections = contact_corrections
+		self.first_new_organization_code = first_new_organization_code
+		# Unmapped organization codes, with the records referring to them.
+		self.unmapped_codes: dict[str, list[str]] = {}
+
+	@staticmethod
+	def from_csv(
+			organization_codes_file: Path = ORGANIZATION_CODES_FILE,
+			contact_corrections_file: Path = CONTACT_CORRECTIONS_FILE,
+			first_new_organization_code: int = FIRST_NEW_ORGANIZATION_CODE) -> "MetadataCorrector":
+		with open(organization_codes_file, "r", newline="", encoding="utf-8") as file:
+			organization_codes = {
+				row["organization_code"].strip(): row["wdcgg_organization_code"].strip()
+				for row in csv.DictReader(file)
+			}
+		contact_corrections: dict[str, dict[str, str]] = {}
+		with open(contact_corrections_file, "r", newline="", encoding="utf-8") as file:
+			for row in csv.DictReader(file):
+				contact_corrections.setdefault(row["field"].strip(), {})[row["value"].strip()] = row["corrected_value"].strip()
+		return MetadataCorrector(organization_codes, contact_corrections, first_new_organization_code)
+
+	def convert_code(self, code: str, referrer: str) -> Optional[str]:
+		if code in self.organization_codes:
+			return self.organization_codes[code]
+		self.unmapped_codes.setdefault(code, []).append(referrer)
+		return None
+
+	def correct_organizations(self, organizations: Iterable[Any]) -> list[dict[str, Any]]:
+		"""Return the corrected organizations that are not included in the WDCGG list, sorted by code."""
+
+		organizations_to_keep: list[dict[str, Any]] = []
+		for organization in map(to_json_value, organizations):
+			new_code = self.convert_code(organization["or_organization_code"], f"organization {organization['or_acronym']}")
+			if new_code is not None and int(new_code) >= self.first_new_organization_code:
+				organization["or_organization_code"] = new_code
+				organizations_to_keep.append(organization)
+		return sorted(organizations_to_keep, key=lambda organization: organization["or_organization_code"])
+
+	def correct_contacts(self, contacts: Iterable[Any]) -> Iterator[dict[str, Any]]:
+		for contact in map(to_json_value, contacts):
+			new_code = self.convert_code(contact["or_organization_code"], f"contact {contact['ps_person_id']}")
+			if new_code is not None:
+				contact["or_organization_code"] = new_code
+			for key, corrections in self.contact_corrections.items():
+				if contact[key] in corrections:
+					contact[key] = corrections[contact[key]]
+			yield contact
+
+	def report(self) -> list[str]:
+		return [
+			f"Organization code {code} is missing from the conversion table (used by {', '.join(referrers)})."
+			for code, referrers in sorted(self.unmapped_codes.items(), key=lambda item: int(item[0]) if item[0].isdigit() else -1)
+		]
+
+
+def corrected_path(path: Path) -> Path:
+	return Path(path.parent, f"corrected_{path.name}")
+
+
+def correct_files(corrector: MetadataCorrector, organizations_file: Path, contacts_file: Path, overwrite: bool = False) -> None:
+	"""Write the corrected versions of an organizations and a contacts metadata file next to them."""
+
+	targets = [corrected_path(organizations_file), corrected_path(contacts_file)]
+	if not overwrite:
+		existing = [str(path) for path in targets if path.exists()]
+		if len(existing) > 0:
+			raise FileExistsError(f"Corrected files already exist: {', '.join(existing)}. Use --overwrite to replace them.")
+	with open(organizations_file, "r") as original_file:
+		write_json_array(corrector.correct_organizations(json.load(original_file)), targets[0])
+	with open(contacts_file, "r") as original_file:
+		write_json_array(corrector.correct_contacts(json.load(original_file)), targets[1])
+
+
+def parse_arguments() -> argparse.Namespace:
+	parser = argparse.ArgumentParser(description="Correct the organization and contact metadata files produced by icos_to_wdcgg.py.")
+	parser.add_argument("organizations_file", type=Path)
+	parser.add_argument("contacts_file", type=Path)
+	parser.add_argument("--overwrite", action="store_true", help="Replace existing corrected files.")
+	parser.add_argument("--organization-codes", type=Path, default=ORGANIZATION_CODES_FILE, help="Conversion table of organization codes to WDCGG organization codes.")
+	parser.add_argument("--contact-corrections", type=Path, default=CONTACT_CORRECTIONS_FILE, help="Corrections of known errors in contact metadata.")
+	parser.add_argument("--first-new-organization-code", type=int, default=FIRST_NEW_ORGANIZATION_CODE, help="Code of the first organization not included in the WDCGG list.")
+	return parser.parse_args()
+
 
 if __name__ == "__main__":
-	correct_organizations(Path(sys.argv[1]))
-	correct_contacts(Path(sys.argv[2]))
\ No newline at end of file
+	args = parse_arguments()
+	corrector = MetadataCorrector.from_csv(args.organization_codes, args.contact_corrections, args.first_new_organization_code)
+	try:
+		correct_files(corrector, args.organizations_file, args.contacts_file, args.overwrite)
+	except FileExistsError as error:
+		sys.exit(str(error))
+	for line in corrector.report():
+		print(line)
+	if len(corrector.unmapped_codes) > 0:
+		sys.exit(1)
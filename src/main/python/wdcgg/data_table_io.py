@@ -0,0 +1,120 @@
+from itertools import repeat
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import pandas as pd
+
+
+SIDECAR_FORMATS = ("parquet", "npz")
+CONSOLIDATED_FILE = "wdcgg_data"
+# Number of decimals of the fixed float formatting of the fast text writer,
+# matching the precision of the fill values of each column.
+COORDINATE_DECIMALS = 9
+DEFAULT_DECIMALS = 3
+# Counts that are stored as floats when some of their values are fill values.
+INTEGER_COLUMNS = ("nvalue",)
+
+
+def write_data_table_text(table: pd.DataFrame, path: Path, fast: bool = False) -> None:
+	"""Write a data table in the WDCGG text format.
+
+	By default, floats are written with the shortest representation that
+	round-trips, as DataFrame.to_csv does. With `fast`, they are written with a
+	fixed number of decimals (9 for coordinates, 3 otherwise, none for counts
+	such as nvalue) by a single format string applied to whole rows, columns
+	holding a single value being formatted only once, which is several times
+	faster.
+	"""
+
+	if not fast:
+		table.to_csv(path, sep=" ", index=False)
+		return
+	fields: list[str] = []
+	columns: list[list] = []
+	for column in table.columns:
+		values = table[column]
+		if column in INTEGER_COLUMNS:
+			field = "%d"
+		elif values.dtype.kind == "f":
+			field = f"%.{COORDINATE_DECIMALS if column in ('latitude', 'longitude') else DEFAULT_DECIMALS}f"
+		else:
+			field = "%s"
+		if len(values) > 0 and (values == values.iloc[0]).all():
+			constant = values.iloc[0]
+			fields.append((field % (constant.item() if isinstance(constant, np.generic) else constant)).replace("%", "%%"))
+		else:
+			fields.append(field)
+			columns.append(values.tolist())
+	row_format = " ".join(fields) + "\n"
+	rows = zip(*columns) if len(columns) > 0 else repeat((), len(table))
+	with open(path, "w") as file:
+		file.write(" ".join(table.columns) + "\n")
+		file.writelines(row_format % row for row in rows)
+
+
+def sidecar_path(sidecar_dir: Path, data_file: str, sidecar_format: str) -> Path:
+	return sidecar_dir / f"{Path(data_file).stem}.{sidecar_format}"
+
+
+def write_sidecar(table: pd.DataFrame, path: Path, sidecar_format: str) -> None:
+	"""Write a data table to a binary sidecar file, in Parquet or compressed NumPy format.
+
+	Columns of mixed types (e.g. QC flags that are either strings or fill
+	values) are stored as strings.
+	"""
+
+	tmp_path = path.with_name(path.name + ".part")
+	if sidecar_format == "parquet":
+		require_pyarrow()
+		table.astype({column: str for column in text_columns(table)}).to_parquet(tmp_path, index=False)
+	elif sidecar_format == "npz":
+		text = text_columns(table)
+		arrays = {
+			column: table[column].to_numpy().astype(str) if column in text else table[column].to_numpy()
+			for column in table.columns
+		}
+		with open(tmp_path, "wb") as file:
+			np.savez_compressed(file, **arrays)
+	else:
+		raise ValueError(f"Unknown sidecar format '{sidecar_format}', expected one of {', '.join(SIDECAR_FORMATS)}.")
+	tmp_path.replace(path)
+
+
+def text_columns(table: pd.DataFrame) -> list[str]:
+	return [column for column in table.columns if not pd.api.types.is_numeric_dtype(table[column])]
+
+
+def read_sidecar(path: Path) -> pd.DataFrame:
+	if path.suffix == ".parquet":
+		require_pyarrow()
+		return pd.read_parquet(path)
+	with np.load(path, allow_pickle=False) as content:
+		return pd.DataFrame({column: content[column] for column in content.files})
+
+
+def consolidate_sidecars(sidecar_dir: Path, data_files: list[str], sidecar_format: str) -> Optional[Path]:
+	"""Concatenate the sidecars of the data files of a delivery into one dataset,
+	with a `data_file` column telling which file each row comes from.
+
+	Returns
+	-------
+	The path to the consolidated dataset, or None if no sidecar was found.
+	"""
+
+	tables = []
+	for data_file in data_files:
+		path = sidecar_path(sidecar_dir, data_file, sidecar_format)
+		if path.exists():
+			tables.append(read_sidecar(path).assign(data_file=data_file))
+	if len(tables) == 0:
+		return None
+	consolidated_path = sidecar_dir / f"{CONSOLIDATED_FILE}.{sidecar_format}"
+	write_sidecar(pd.concat(tables, ignore_index=True), consolidated_path, sidecar_format)
+	return consolidated_path
+
+
+def require_pyarrow() -> None:
+	try:
+		import pyarrow  # noqa: F401
+	except ImportError:
+		raise ImportError("Parquet sidecars require the pyarrow package; install it or use the npz format.") from None
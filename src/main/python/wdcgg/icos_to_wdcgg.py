@@ -1,71 +1,290 @@
 #!/home/jonathan-schenk/miniconda3/envs/data/bin/python
 
 import sys
-import os
+import json
+import argparse
 from pathlib import Path
 from datetime import datetime
-import json
 import warnings
-from typing import Any
-from wdcgg_metadata import WdcggMetadataClient, get_dobj_info
-from obspack_netcdf import ObspackNetcdf
-from sparql import SubmissionWindow, run_sparql_select_query_single_param, obspack_time_series_query
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from itertools import chain, tee
+from typing import Callable, Iterable, Iterator, Tuple, Optional, TypeVar
+from wdcgg_metadata import WdcggMetadataClient, DobjInfo, iter_dobj_infos
+from obspack_netcdf import ObspackNetcdf, InstrumentDeployment
+from sparql import SubmissionWindow, SparqlClient, get_sparql_client, set_sparql_client, DEFAULT_PAGE_SIZE
+from sparql_cache import SparqlCache, DEFAULT_CACHE_FILE
+from netcdf_cache import NetcdfCache
+from data_table_io import SIDECAR_FORMATS, write_data_table_text, write_sidecar, sidecar_path, consolidate_sidecars, require_pyarrow
+from run_manifest import RunManifest, ManifestEntry
+from station_registry import StationRegistry, STATION_FILE, ADDITIONAL_STATIONS_FILE
+from wdcgg_json import JsonArrayWriter, WdcggJSONEncoder, write_json_array
+from retry import Retrier, RetryPolicy, RetryStats, get_download_retrier, use_download_retry_policy
+from correct_metadata import MetadataCorrector, corrected_path
+from validate_json import RecordValidator, InvalidRecordError, METADATA_FILE, CONTACTS_FILE, ORGANIZATIONS_FILE
+
+
+T = TypeVar("T")
+
+
+def wdcgg_station_ids(dobj_info: DobjInfo, station_registry: StationRegistry) -> Tuple[str, str]:
+	"""Return the WDCGG station ID and the old four-digit WDCGG station ID of the data object's station."""
+
+	station = station_registry.by_gaw_id(dobj_info.station.id)
+	if station is None:
+		warnings.warn(f"Station {dobj_info.station.id} is not registered in GAWSIS.")
+		return "-", ""
+	else:
+		return station.wdcgg_id, station.four_digit_id
+
+
+def export_data_object(
+		dobj_url: str,
+		wdcgg_station_id: str,
+		out_dir: Path,
+		spool_dir: Optional[Path] = None,
+		in_memory: bool = False,
+		netcdf_cache: Optional[NetcdfCache] = None,
+		fast_text: bool = False,
+		sidecar_format: Optional[str] = None,
+		sidecar_dir: Optional[Path] = None) -> Tuple[str, list[InstrumentDeployment], RetryStats]:
+	"""Download a data object, write its data file and return the file name,
+	the instrument history and the retry counters of the download.
+
+	This is the I/O-heavy part of the processing of a data object, which can
+	run in a worker process since it does not touch the metadata client.
+	If a sidecar format is given, the data table is also written to a binary
+	sidecar file in the sidecar directory.
+	"""
 
+	retrier = get_download_retrier()
+	stats_before = retrier.snapshot()
+	with ObspackNetcdf(dobj_url, spool_dir, in_memory, netcdf_cache) as netcdf_data:
+		data_file, data_table = netcdf_data.wdcgg_data_table(wdcgg_station_id)
+		write_data_table_text(data_table, out_dir / data_file, fast_text)
+		if sidecar_format is not None and sidecar_dir is not None:
+			write_sidecar(data_table, sidecar_path(sidecar_dir, data_file, sidecar_format), sidecar_format)
+		return data_file, netcdf_data.instrument_history("time", "instrument"), retrier.snapshot().since(stats_before)
+
+
+def bounded_map(executor: Executor, func: Callable[..., T], *iterables: Iterable[object], max_pending: int) -> Iterator[T]:
+	"""Like Executor.map, but with at most `max_pending` calls submitted and not
+	consumed yet, so that a failure does not leave the whole input queued.
+	Results are yielded in submission order, and the calls that have not
+	started yet are cancelled if the iteration stops early."""
+
+	arguments = zip(*iterables)
+	pending: deque[Future[T]] = deque()
+	try:
+		for args in arguments:
+			pending.append(executor.submit(func, *args))
+			if len(pending) >= max_pending:
+				break
+		while len(pending) > 0:
+			result = pending.popleft().result()
+			args = next(arguments, None)
+			if args is not None:
+				pending.append(executor.submit(func, *args))
+			yield result
+	finally:
+		for future in pending:
+			future.cancel()
+
+
+def record_dobj_metadata(
+		client: WdcggMetadataClient,
+		manifest: RunManifest,
+		dobj_info: DobjInfo,
+		data_file: str,
+		instr_hist: list[InstrumentDeployment],
+		old_wdcgg_station_id: str,
+		quarantine_dir: Optional[Path] = None) -> bool:
+	"""Produce the metadata of a processed data object and record its contribution in the run manifest.
+
+	If the client validates records and the metadata of the data object is
+	invalid, the error is raised, unless a quarantine directory is given: the
+	data file is then moved to it, next to a report of the schema violations,
+	and the data object is recorded in the manifest as quarantined.
 
-def parse_wdcgg_station_file() -> dict[str, dict[str, str]]:
-	"""Parse the WDCGG station file to produce a conversion dictionary
-	from GAWSIS station IDs to WDCGG station IDs.
-	
 	Returns
 	-------
-	A dictionary where the keys correspond to GAWSIS station IDs and the values
-	correspond to WDCGG station IDs.
+	False if the data object was quarantined, True otherwise.
 	"""
-	
-	wdcgg_station_file = "station.csv"
-	with open(wdcgg_station_file, "r") as f:
-		lines = f.read().split("\n")[1:-1]
-	lines = [[val.strip('"') for val in line.split(",")] for line in lines]
-	lookup_dict = {line[1]: {"4-digit": line[0], "wdcgg-id": line[2]} for line in lines}
-	additional_entries = {
-		"KRE": {"4-digit": "6379", "wdcgg-id": "KRE6379"},
-		"SAC": {"4-digit": "6423", "wdcgg-id": "SAC6423"}
+
+	n_contacts = len(client.contacts)
+	n_organizations = len(client.organizations)
+	try:
+		metadata = client.dobj_metadata(dobj_info, instr_hist, old_wdcgg_station_id)
+		quarantined = False
+	except InvalidRecordError as error:
+		if quarantine_dir is None:
+			raise
+		metadata = error.record
+		quarantined = True
+		quarantine_data_object(quarantine_dir, dobj_info, data_file, error)
+	manifest.record(ManifestEntry(
+		url=dobj_info.url,
+		data_file=data_file,
+		metadata=metadata,
+		contacts=client.contacts[n_contacts:],
+		contact_ids=dict(list(client.contact_ids.items())[n_contacts:]),
+		organizations=client.organizations[n_organizations:],
+		organization_ids=dict(list(client.organization_ids.items())[n_organizations:]),
+		quarantined=quarantined
+	))
+	return not quarantined
+
+
+def quarantine_data_object(quarantine_dir: Path, dobj_info: DobjInfo, data_file: str, error: InvalidRecordError) -> None:
+	quarantine_dir.mkdir(parents=True, exist_ok=True)
+	data_path = quarantine_dir.parent / data_file
+	if data_path.exists():
+		data_path.replace(quarantine_dir / data_file)
+	report = {
+		"url": dobj_info.url,
+		"data_file": data_file,
+		"errors": [str(record_error) for record_error in error.errors],
+		"metadata": error.record
 	}
-	for gaw_id, wdcgg_ids in additional_entries.items():
-		if gaw_id not in lookup_dict.keys():
-			lookup_dict[gaw_id] = wdcgg_ids
-	return lookup_dict
+	with open(quarantine_dir / f"{Path(data_file).stem}.errors.json", "w") as file:
+		json.dump(report, file, cls=WdcggJSONEncoder, indent=2)
+	warnings.warn(f"Metadata of data object {dobj_info.url} is invalid, the data object was quarantined:\n{error}")
 
 
-def write_json_to_file(json_object: list[dict[str, Any]], out_dir: Path, file_path: str) -> None:
-	with open(os.path.join(out_dir, file_path), "w") as file:
-		file.write(json.dumps(json_object))
+def parse_arguments() -> argparse.Namespace:
+	parser = argparse.ArgumentParser(description="Produce data and metadata files formatted for WDCGG processing.")
+	parser.add_argument("earliest_submission_time", type=datetime.fromisoformat)
+	parser.add_argument("latest_submission_time", type=datetime.fromisoformat)
+	parser.add_argument("output_directory", type=Path)
+	parser.add_argument("--station-file", type=Path, default=STATION_FILE, help="WDCGG station list.")
+	parser.add_argument("--additional-stations-file", type=Path, default=ADDITIONAL_STATIONS_FILE, help="Stations missing from the WDCGG station list.")
+	parser.add_argument("--cache-file", type=Path, default=DEFAULT_CACHE_FILE, help="SQLite file caching SPARQL results.")
+	parser.add_argument("--no-cache", action="store_true", help="Bypass the SPARQL result cache.")
+	parser.add_argument("--purge-cache", action="store_true", help="Empty the SPARQL result cache before running.")
+	parser.add_argument("--concurrent-queries", type=int, default=1, help="Maximum number of batched SPARQL queries running at the same time.")
+	parser.add_argument("--query-interval", type=float, default=0.0, help="Minimum time in seconds between the starts of two concurrent SPARQL queries.")
+	parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="Number of data objects listed per SPARQL request (0 to list them all in one request).")
+	parser.add_argument("--spool-dir", type=Path, help="Directory where downloaded netCDF files are spooled (default: system temporary directory).")
+	parser.add_argument("--in-memory", action="store_true", help="Keep downloaded netCDF files in memory instead of spooling them to disk.")
+	parser.add_argument("--netcdf-cache-dir", type=Path, help="Directory where downloaded netCDF files are cached across runs.")
+	parser.add_argument("--netcdf-cache-size", type=float, default=20, help="Maximum size in GB of the netCDF file cache.")
+	parser.add_argument("--prewarm", action="store_true", help="Only download the data objects of the submission window to the netCDF file cache.")
+	parser.add_argument("--restart", action="store_true", help="Ignore the run manifest of the output directory and process all data objects again.")
+	parser.add_argument("--incremental", action="store_true", help="Only process data objects that were not delivered by previous runs in the output directory.")
+	parser.add_argument("--fast-text", action="store_true", help="Write floats in data files with a fixed number of decimals, which is much faster.")
+	parser.add_argument("--sidecar", choices=SIDECAR_FORMATS, help="Also write each data table, and their concatenation, in a binary format.")
+	parser.add_argument("--sidecar-dir", type=Path, help="Directory of the binary sidecar files (default: 'sidecars' in the output directory).")
+	parser.add_argument("--max-attempts", type=int, default=RetryPolicy.max_attempts, help="Maximum number of attempts of a SPARQL query or download failing because of a transient error.")
+	parser.add_argument("--retry-delay", type=float, default=RetryPolicy.base_delay, help="Delay in seconds before the first retry, doubled at each following retry.")
+	parser.add_argument("--workers", type=int, default=1, help="Number of processes downloading and writing data objects in parallel.")
+	parser.add_argument("--correct", action="store_true", help="Also write the corrected organization and contact metadata files (see correct_metadata.py).")
+	parser.add_argument("--validate", choices=("fail", "quarantine"), help="Validate metadata records as they are produced, and stop at the first invalid one or quarantine the data objects with invalid metadata.")
+	return parser.parse_args()
 
 
 if __name__ == "__main__":
-	submission_window = SubmissionWindow(
-		datetime.fromisoformat(sys.argv[1]), datetime.fromisoformat(sys.argv[2]))
-	out_dir = Path(sys.argv[3])
+	args = parse_arguments()
+	submission_window = SubmissionWindow(args.earliest_submission_time, args.latest_submission_time)
+	out_dir = args.output_directory
 	if not out_dir.exists(): out_dir.mkdir(parents=True)
-	gawsis_to_wdcgg_station_id = parse_wdcgg_station_file()
-	wdcgg_metadata_client = WdcggMetadataClient(submission_window)
-	sparql_query = obspack_time_series_query(submission_window)
-	dobj_urls = run_sparql_select_query_single_param(sparql_query, str)
-	for dobj_url in dobj_urls:
-		dobj_meta = get_dobj_info(dobj_url)
-		if dobj_meta is None: continue
-		print(dobj_meta.file_name)
-		if dobj_meta.station.id not in gawsis_to_wdcgg_station_id.keys():
-			warnings.warn(f"Station {dobj_meta.station.id} is not registered in GAWSIS.")
-			wdcgg_station_id = "-"
-			old_wdcgg_station_id = ""
+	sparql_cache = None if args.no_cache else SparqlCache(args.cache_file)
+	if sparql_cache is not None and args.purge_cache: sparql_cache.purge()
+	retry_policy = RetryPolicy(max_attempts=args.max_attempts, base_delay=args.retry_delay)
+	set_sparql_client(SparqlClient(cache=sparql_cache, retrier=Retrier(retry_policy)))
+	use_download_retry_policy(retry_policy)
+	station_registry = StationRegistry.load(args.station_file, args.additional_stations_file)
+	if args.sidecar == "parquet": require_pyarrow()
+	manifest = RunManifest.open(out_dir, submission_window, args.restart, args.incremental)
+	# Data objects are processed while the following pages of the listing are fetched.
+	dobj_infos: Iterator[DobjInfo] = (
+		dobj_info for dobj_info in iter_dobj_infos(submission_window, args.page_size, args.concurrent_queries)
+		if not manifest.is_processed(dobj_info.url)
+	)
+	if args.netcdf_cache_dir is None:
+		netcdf_cache = None
+	else:
+		netcdf_cache = NetcdfCache(args.netcdf_cache_dir, int(args.netcdf_cache_size * 1024**3))
+	if args.prewarm:
+		if netcdf_cache is None:
+			raise ValueError("A netCDF cache directory must be given with --netcdf-cache-dir to prewarm the cache.")
+		netcdf_cache.prewarm([dobj_info.url for dobj_info in dobj_infos], args.workers)
+		print(f"Downloads: {get_download_retrier().stats}.")
+		sys.exit(0)
+	first_dobj_info = next(dobj_infos, None)
+	if first_dobj_info is None and len(manifest.entries) == 0 and args.incremental:
+		manifest.mark_complete()
+		print("No new data object to deliver.")
+		sys.exit(0)
+	if first_dobj_info is not None:
+		dobj_infos = chain([first_dobj_info], dobj_infos)
+	# Files are written to the output directory, or to a subdirectory of it
+	# for each incremental delivery.
+	delivery_dir = manifest.delivery_directory
+	delivery_dir.mkdir(parents=True, exist_ok=True)
+	sidecar_dir = args.sidecar_dir or delivery_dir / "sidecars"
+	if args.sidecar is not None:
+		sidecar_dir.mkdir(parents=True, exist_ok=True)
+	# Metadata records are written as soon as they are produced, starting with
+	# those of the data objects processed by an interrupted run.
+	metadata_writer = JsonArrayWriter(delivery_dir / METADATA_FILE)
+	validator = None if args.validate is None else RecordValidator()
+	quarantine_dir = delivery_dir / "quarantine" if args.validate == "quarantine" else None
+	wdcgg_metadata_client = WdcggMetadataClient(submission_window, args.concurrent_queries, metadata_writer.write, validator, args.query_interval)
+	for entry in manifest.entries:
+		wdcgg_metadata_client.restore(entry.metadata, entry.contacts, entry.contact_ids, entry.organizations, entry.organization_ids, entry.quarantined)
+	wdcgg_metadata_client.prefetch_instruments()
+	wdcgg_metadata_client.prefetch_obspack_releases()
+	listing = (
+		(dobj_info, *wdcgg_station_ids(dobj_info, station_registry))
+		for dobj_info in wdcgg_metadata_client.with_contributor_roles(dobj_infos, args.page_size)
+	)
+	# The listing is read once, and shared by the exports, which run ahead, and the metadata.
+	to_record, to_export_urls, to_export_ids = tee(listing, 3)
+	export = partial(
+		export_data_object, out_dir=delivery_dir, spool_dir=args.spool_dir, in_memory=args.in_memory, netcdf_cache=netcdf_cache,
+		fast_text=args.fast_text, sidecar_format=args.sidecar, sidecar_dir=sidecar_dir
+	)
+	download_stats = RetryStats()
+	n_quarantined = sum(entry.quarantined for entry in manifest.entries)
+	with ProcessPoolExecutor(max_workers=args.workers, initializer=use_download_retry_policy, initargs=(retry_policy, get_download_retrier().breaker)) if args.workers > 1 else nullcontext() as executor:
+		# Results are consumed in submission order, so that contact and organization
+		# IDs are assigned exactly as in a serial run.
+		urls = (dobj_info.url for dobj_info, _, _ in to_export_urls)
+		wdcgg_ids = (wdcgg_station_id for _, wdcgg_station_id, _ in to_export_ids)
+		if executor is None:
+			exports = map(export, urls, wdcgg_ids)
 		else:
-			wdcgg_station_id = gawsis_to_wdcgg_station_id[dobj_meta.station.id]["wdcgg-id"]
-			old_wdcgg_station_id = gawsis_to_wdcgg_station_id[dobj_meta.station.id]["4-digit"]
-		netcdf_data = ObspackNetcdf(dobj_url)
-		data_file, data_table = netcdf_data.wdcgg_data_table(wdcgg_station_id)
-		data_table.to_csv(os.path.join(out_dir, data_file), sep=" ", index=False)
-		wdcgg_metadata_client.dobj_metadata(dobj_meta, netcdf_data, old_wdcgg_station_id)
-	write_json_to_file(wdcgg_metadata_client.metadata, out_dir, "wdcgg_metadata.json")
-	write_json_to_file(wdcgg_metadata_client.contacts, out_dir, "wdcgg_contacts.json")
-	write_json_to_file(wdcgg_metadata_client.organizations, out_dir, "wdcgg_organizations.json")
\ No newline at end of file
+			exports = bounded_map(executor, export, urls, wdcgg_ids, max_pending=2 * args.workers)
+		try:
+			for (dobj_meta, _, old_wdcgg_station_id), (data_file, instr_hist, stats) in zip(to_record, exports):
+				print(dobj_meta.file_name)
+				download_stats.add(stats)
+				if not record_dobj_metadata(wdcgg_metadata_client, manifest, dobj_meta, data_file, instr_hist, old_wdcgg_station_id, quarantine_dir):
+					n_quarantined += 1
+		except BaseException:
+			# Only wait for the exports already running, not for the queued ones.
+			if executor is not None:
+				executor.shutdown(cancel_futures=True)
+			raise
+	metadata_writer.finalize()
+	contacts = wdcgg_metadata_client.valid_contacts()
+	organizations = wdcgg_metadata_client.valid_organizations()
+	write_json_array(contacts, delivery_dir / CONTACTS_FILE)
+	write_json_array(organizations, delivery_dir / ORGANIZATIONS_FILE)
+	if args.correct:
+		corrector = MetadataCorrector.from_csv()
+		write_json_array(corrector.correct_organizations(organizations), corrected_path(delivery_dir / ORGANIZATIONS_FILE))
+		write_json_array(corrector.correct_contacts(contacts), corrected_path(delivery_dir / CONTACTS_FILE))
+		for line in corrector.report():
+			warnings.warn(line)
+	manifest.mark_complete()
+	if args.sidecar is not None:
+		consolidate_sidecars(sidecar_dir, manifest.data_files, args.sidecar)
+	if sparql_cache is not None:
+		print(f"SPARQL cache: {sparql_cache.hits} hits, {sparql_cache.misses} misses.")
+	print(f"SPARQL queries: {get_sparql_client().retrier.stats}.")
+	print(f"Downloads: {download_stats}.")
+	if n_quarantined > 0:
+		print(f"{n_quarantined} data objects with invalid metadata were quarantined in {quarantine_dir}.")
\ No newline at end of file
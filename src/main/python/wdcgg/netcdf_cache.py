@@ -0,0 +1,142 @@
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Tuple
+from icoscp_core.icos import data
+from retry import Retrier, get_download_retrier
+
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "icos_to_wdcgg" / "netcdf"
+DEFAULT_MAX_SIZE = 20 * 1024**3
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def download_data_object(url: str, directory: Optional[Path] = None, suffix: str = ".nc", retrier: Optional[Retrier] = None) -> Path:
+	"""Stream a data object in chunks to a new temporary file.
+
+	The download is started again from the beginning if it fails because of a
+	transient error (see retry.Retrier). The module-level download retrier is
+	used by default.
+
+	Returns
+	-------
+	The path to the temporary file, which the caller is responsible for removing.
+	"""
+
+	def download() -> Path:
+		_, stream = data.get_file_stream(url)
+		with tempfile.NamedTemporaryFile(dir=directory, suffix=suffix, delete=False) as tmp_file:
+			path = Path(tmp_file.name)
+			try:
+				shutil.copyfileobj(stream, tmp_file, DOWNLOAD_CHUNK_SIZE)
+			except BaseException:
+				path.unlink()
+				raise
+		return path
+
+	return (retrier or get_download_retrier()).call(download, f"Download of {url}")
+
+
+def read_data_object(url: str, retrier: Optional[Retrier] = None) -> Tuple[str, bytes]:
+	"""Read a data object into memory, retrying after transient errors.
+
+	Returns
+	-------
+	The file name and the content of the data object.
+	"""
+
+	def read() -> Tuple[str, bytes]:
+		file_name, stream = data.get_file_stream(url)
+		return file_name, stream.read()
+
+	return (retrier or get_download_retrier()).call(read, f"Download of {url}")
+
+
+def dobj_hash_id(url: str) -> str:
+	return url.rstrip("/").split("/")[-1]
+
+
+def content_hash_id(path: Path) -> str:
+	"""Compute the ICOS hash ID of a file, i.e. the URL-safe base64 encoding
+	of the first 18 bytes of its SHA-256 hash sum."""
+
+	sha256 = hashlib.sha256()
+	with open(path, "rb") as file:
+		while chunk := file.read(DOWNLOAD_CHUNK_SIZE):
+			sha256.update(chunk)
+	return base64.urlsafe_b64encode(sha256.digest()[:18]).decode()
+
+
+class NetcdfCache:
+	"""Local cache of data object files, keyed by the hash ID in the data object's URL.
+
+	ICOS data objects are immutable and their URL ends with the hash of their
+	content, which is used to check the integrity of the cached files. When the
+	total size of the cache exceeds the size limit, the least recently used
+	files are removed.
+
+	Parameters
+	----------
+	cache_dir : Path
+		Directory where the files are stored, created if it does not exist.
+	max_size : int
+		Maximum total size in bytes of the cached files.
+	verify_hits : bool
+		Check the integrity of a cached file every time it is used.
+	"""
+
+	def __init__(self, cache_dir: Path = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_MAX_SIZE, verify_hits: bool = True):
+		cache_dir.mkdir(parents=True, exist_ok=True)
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+		self.verify_hits = verify_hits
+
+	def path(self, url: str) -> Path:
+		return self.cache_dir / f"{dobj_hash_id(url)}.nc"
+
+	def fetch(self, url: str) -> Path:
+		"""Return the path to the cached file of the data object, downloading it if needed."""
+
+		path = self.path(url)
+		if path.exists():
+			if not self.verify_hits or content_hash_id(path) == dobj_hash_id(url):
+				os.utime(path)
+				return path
+			path.unlink(missing_ok=True)
+		tmp_path = download_data_object(url, self.cache_dir, ".part")
+		if content_hash_id(tmp_path) != dobj_hash_id(url):
+			tmp_path.unlink()
+			raise IOError(f"Content of the file downloaded from {url} does not match its hash.")
+		os.replace(tmp_path, path)
+		self.evict(keep=path)
+		return path
+
+	def prewarm(self, urls: list[str], workers: int = 1) -> None:
+		"""Download the data objects that are not cached yet, with several threads if requested."""
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			list(executor.map(self.fetch, urls))
+
+	def evict(self, keep: Optional[Path] = None) -> None:
+		"""Remove the least recently used files until the cache fits in its size limit.
+
+		The file `keep`, which has just been fetched, is never removed, even if
+		it is larger than the limit on its own.
+		"""
+
+		files: list[tuple[float, int, Path]] = []
+		for path in self.cache_dir.glob("*.nc"):
+			try:
+				stat = path.stat()
+			except FileNotFoundError:
+				continue
+			files.append((stat.st_mtime, stat.st_size, path))
+		total = 0
+		for _, size, path in sorted(files, reverse=True):
+			total += size
+			if total > self.max_size and path != keep:
+				path.unlink(missing_ok=True)
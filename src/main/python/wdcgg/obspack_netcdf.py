@@ -1,9 +1,10 @@
+from pathlib import Path
 from dataclasses import dataclass
-from typing import Any, TypeAlias, Tuple
+from typing import Any, TypeAlias, Tuple, Optional
 import numpy as np
 import netCDF4
 import pandas as pd
-from icoscp_core.icos import data
+from netcdf_cache import NetcdfCache, download_data_object, read_data_object
 
 
 Dataset: TypeAlias = Any
@@ -22,9 +23,54 @@ class InstrumentDeployment:
 
 
 class ObspackNetcdf:
-	def __init__(self, url: str):
-		file_name, buffer = data.get_file_stream(url)
-		self.dataset: Dataset = netCDF4.Dataset(file_name, memory=buffer.read())
+	"""Obspack netCDF data object downloaded from the ICOS Carbon Portal.
+
+	By default, the file is streamed in chunks to a temporary spool file that
+	is opened by path, so that variables are read lazily through the OS page
+	cache instead of holding the whole file in memory. The spool file is
+	removed by close(), which is called when used as a context manager.
+	If a cache is given, the file is taken from (or downloaded to) the cache
+	and is kept after closing.
+
+	Parameters
+	----------
+	url : str
+		Data object's URL.
+	spool_dir : Path, optional
+		Directory for the spool file. Defaults to the system's temporary directory.
+	in_memory : bool
+		Read the whole file into memory instead of spooling it to disk.
+	cache : NetcdfCache, optional
+		Local cache of data object files.
+	"""
+
+	def __init__(self, url: str, spool_dir: Optional[Path] = None, in_memory: bool = False, cache: Optional[NetcdfCache] = None):
+		self.spool_file: Optional[Path] = None
+		if cache is not None:
+			try:
+				self.dataset: Dataset = netCDF4.Dataset(cache.fetch(url), "r")
+			except FileNotFoundError:
+				# Evicted by another worker between the fetch and the opening: fetch it again.
+				self.dataset = netCDF4.Dataset(cache.fetch(url), "r")
+		elif in_memory:
+			file_name, content = read_data_object(url)
+			self.dataset = netCDF4.Dataset(file_name, memory=content)
+		else:
+			self.spool_file = download_data_object(url, spool_dir)
+			self.dataset = netCDF4.Dataset(self.spool_file, "r")
+
+	def __enter__(self) -> "ObspackNetcdf":
+		return self
+
+	def __exit__(self, *exc_info: Any) -> None:
+		self.close()
+
+	def close(self) -> None:
+		if self.dataset.isopen():
+			self.dataset.close()
+		if self.spool_file is not None:
+			self.spool_file.unlink(missing_ok=True)
+			self.spool_file = None
 
 	def instrument_history(self, time_var: str, instr_var: str) -> list[InstrumentDeployment]:
 		"""List which instruments were used and when.
@@ -40,25 +86,29 @@ class ObspackNetcdf:
 		-------
 		A list of InstrumentDeployment objects containing the ATC ID
 		of the instrument, and the start and end time of the deployment.
+		The list is empty if the instrument variable contains no valid value.
 		"""
 
-		time = self.dataset.variables[time_var][:]
-		instr = self.dataset.variables[instr_var][:]
-
-		tstart = time[0]
-		current_instr = instr[0]
-		deployments: list[InstrumentDeployment] = []
-		for n, t in enumerate(time[:-1]):
-			if instr[n + 1] != current_instr:
-				depl = InstrumentDeployment(current_instr, TimePeriod(tstart, t))
-				deployments.append(depl)
-				tstart = time[n + 1]
-				current_instr = instr[n + 1]
-		else:
-			depl = InstrumentDeployment(current_instr, TimePeriod(tstart, time[-1]))
-			deployments.append(depl)
+		time = np.ma.getdata(self.dataset.variables[time_var][:])
+		instr = np.ma.asarray(self.dataset.variables[instr_var][:])
 
-		return deployments
+		# Masked (fill) instrument values do not start a new deployment: they are
+		# attributed to the previous valid instrument, or to the first valid
+		# instrument if they occur at the beginning of the series.
+		valid = ~np.ma.getmaskarray(instr)
+		valid_indices = np.flatnonzero(valid)
+		if valid_indices.size == 0:
+			return []
+		fill_indices = np.maximum.accumulate(np.where(valid, np.arange(instr.size), valid_indices[0]))
+		instr_filled = np.ma.getdata(instr)[fill_indices]
+
+		changes = np.flatnonzero(instr_filled[1:] != instr_filled[:-1]) + 1
+		starts = np.concatenate(([0], changes))
+		ends = np.concatenate((changes - 1, [instr_filled.size - 1]))
+		return [
+			InstrumentDeployment(int(instr_filled[start]), TimePeriod(float(time[start]), float(time[end])))
+			for start, end in zip(starts, ends)
+		]
 
 	def wdcgg_data_table(self, wdcgg_station_id: str) -> Tuple[str, pd.DataFrame]:
 		"""Structure the data in a table complying with WDCGG requirements.
@@ -71,50 +121,70 @@ class ObspackNetcdf:
 
 		conv_factor = 1e6 if self.dataset.dataset_parameter == "co2" else 1e9
 		filename = "_".join(self.dataset.dataset_name.split("_")[:3] + [f"{int(float(self.dataset.dataset_intake_ht))}magl", CONTRIBUTOR, "hourly.txt"])
+		variables = self.dataset.variables
+
+		# Zero and missing time components are replaced by fill values.
+		time_components = np.ma.filled(variables["time_components"][:], 0)
+		start_time = {
+			col: np.where(time_components[:, n] == 0, -999 if n == 0 else -9, time_components[:, n])
+			for n, col in enumerate(["st_year", "st_month", "st_day", "st_hour", "st_minute", "st_second"])
+		}
+
+		value = self.scaled_values("value", conv_factor)
+		value_sd = self.scaled_values("value_std_dev", conv_factor)
+		nvalue = variables["nvalue"][:]
+		if np.ma.is_masked(nvalue):
+			nvalue = np.ma.filled(nvalue.astype(np.float64), -9)
+		else:
+			nvalue = np.ma.getdata(nvalue)
+		value_wmo_scale = value.copy()
+		value[nvalue == 0] = -999.999
+		value_sd[(nvalue == 0) | (nvalue == 1)] = -999.999
+
+		qc_flag = np.char.decode(np.ma.filled(variables["qc_flag"][:], b""), "utf-8").astype(object)
+		qc_flag[qc_flag == ""] = -9
+
+		site_elevation = float(self.dataset.site_elevation)
+		intake_height = float(self.dataset.dataset_intake_ht)
 		table = pd.DataFrame({
 			"site_wdcgg_id": wdcgg_station_id,
-			"st_year": [tc[0] or -999 for tc in self.dataset.variables["time_components"][:].tolist()],
-			"st_month": [tc[1] or -9 for tc in self.dataset.variables["time_components"][:].tolist()],
-			"st_day": [tc[2] or -9 for tc in self.dataset.variables["time_components"][:].tolist()],
-			"st_hour": [tc[3] or -9 for tc in self.dataset.variables["time_components"][:].tolist()],
-			"st_minute": [tc[4] or -9 for tc in self.dataset.variables["time_components"][:].tolist()],
-			"st_second": [tc[5] or -9 for tc in self.dataset.variables["time_components"][:].tolist()],
+			**start_time,
 			"end_year": -999,
 			"end_month": -9,
 			"end_day": -9,
 			"end_hour": -9,
 			"end_minute": -9,
 			"end_second": -9,
-			"value": self.dataset.variables["value"][:]*conv_factor,
-			"value_wmo_scale": self.dataset.variables["value"][:]*conv_factor,
-			"value_sd": self.dataset.variables["value_std_dev"][:]*conv_factor,
-			"value_unc_1": self.dataset.variables["icos_SMR"][:]*conv_factor,     # continuous measurement repeatability
+			"value": value,
+			"value_wmo_scale": value_wmo_scale,
+			"value_sd": value_sd,
+			"value_unc_1": self.scaled_values("icos_SMR", conv_factor),     # continuous measurement repeatability
 			"value_unc_1_id": -9,
 			"value_unc_1_method": 10,
-			"value_unc_2": self.dataset.variables["icos_LTR"][:]*conv_factor,     # long term repeatability
+			"value_unc_2": self.scaled_values("icos_LTR", conv_factor),     # long term repeatability
 			"value_unc_2_id": -9,
 			"value_unc_2_method": 10,
-			"value_unc_3": self.dataset.variables["icos_STTB"][:]*conv_factor,    # short term target bias
+			"value_unc_3": self.scaled_values("icos_STTB", conv_factor),    # short term target bias
 			"value_unc_3_id": -9,
 			"value_unc_3_method": 10,
-			"nvalue": self.dataset.variables["nvalue"][:],
+			"nvalue": nvalue,
 			"latitude": self.dataset.site_latitude or -999.999999999,
 			"longitude": self.dataset.site_longitude or -999.999999999,
-			"altitude": float(self.dataset.site_elevation) + float(self.dataset.dataset_intake_ht) or -999999.999,
-			"elevation": float(self.dataset.site_elevation) or -999999.999,
-			"intake_height": float(self.dataset.dataset_intake_ht) or -999999.999,
+			"altitude": site_elevation + intake_height or -999999.999,
+			"elevation": site_elevation or -999999.999,
+			"intake_height": intake_height or -999999.999,
 			"flask_no": -999.999,
-			"ORG_QCflag": [flag.decode() or -9 for flag in self.dataset.variables["qc_flag"][:].tolist()],
+			"ORG_QCflag": qc_flag,
 			"QCflag": -9,
 			"instrument": -9,
 			"measurement_method": -9,
 			"scale": -9
 		})
-		value_columns = ["value", "value_wmo_scale", "value_sd", "value_unc_1", "value_unc_2", "value_unc_3"]
-		for col in value_columns:
-			table[col] = table[col].replace(np.nan, -999.999)
-		table["nvalue"] = table["nvalue"].replace(np.nan, -9)
-		table = table.astype({col: np.float64 for col in value_columns})
-		table.loc[table["nvalue"] == 0, "value"] = -999.999
-		table.loc[np.logical_or(table["nvalue"] == 0, table["nvalue"] == 1), "value_sd"] = -999.999
-		return filename, table
\ No newline at end of file
+		return filename, table
+
+	def scaled_values(self, var_name: str, conv_factor: float) -> np.ndarray:
+		"""Read a variable once and convert it to the WDCGG unit, with -999.999 for missing values."""
+
+		values = np.ma.filled((self.dataset.variables[var_name][:] * conv_factor).astype(np.float64), np.nan)
+		values[np.isnan(values)] = -999.999
+		return values
\ No newline at end of file
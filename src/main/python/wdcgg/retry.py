@@ -0,0 +1,273 @@
+import asyncio
+import http.client
+import multiprocessing
+import random
+import re
+import threading
+import time
+import urllib.error
+import warnings
+from dataclasses import dataclass, fields
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Optional, Tuple, TypeVar
+import httpx
+import requests
+
+
+T = TypeVar("T")
+
+DEFAULT_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# icoscp_core turns HTTP errors into plain exceptions, keeping the status code in the message.
+ICOSCP_STATUS_PATTERN = re.compile(r"HTTP response code: (\d{3})")
+
+
+@dataclass
+class RetryPolicy:
+	"""How failed requests are retried.
+
+	Parameters
+	----------
+	max_attempts :      Maximum number of attempts of a request, including the first one.
+	base_delay :        Delay in seconds before the first retry, doubled at each following retry.
+	max_delay :         Maximum delay in seconds between two attempts, when the server gives no Retry-After.
+	max_retry_after :   Maximum delay in seconds accepted from a Retry-After header.
+	retry_statuses :    HTTP status codes of the responses that are retried.
+	"""
+	max_attempts: int = 5
+	base_delay: float = 1.0
+	max_delay: float = 60.0
+	max_retry_after: float = 300.0
+	retry_statuses: frozenset[int] = DEFAULT_RETRY_STATUSES
+
+	def backoff(self, attempt: int) -> float:
+		"""Exponential backoff with jitter: a random delay between half and all of
+		base_delay * 2^attempt, capped at max_delay."""
+
+		delay = min(self.max_delay, self.base_delay * 2**attempt)
+		return delay / 2 + random.uniform(0, delay / 2)
+
+
+@dataclass
+class RetryStats:
+	requests: int = 0
+	retries: int = 0
+	failures: int = 0
+	breaker_trips: int = 0
+	wait_time: float = 0.0
+
+	def add(self, other: "RetryStats") -> None:
+		for stat in fields(self):
+			setattr(self, stat.name, getattr(self, stat.name) + getattr(other, stat.name))
+
+	def since(self, earlier: "RetryStats") -> "RetryStats":
+		return RetryStats(**{stat.name: getattr(self, stat.name) - getattr(earlier, stat.name) for stat in fields(self)})
+
+	def __str__(self) -> str:
+		return (
+			f"{self.requests} requests, {self.retries} retries, {self.failures} failures, "
+			f"{self.breaker_trips} circuit breaker trips, {self.wait_time:.1f} s waited"
+		)
+
+
+class CircuitBreaker:
+	"""Pause all requests to a server after too many consecutive transient failures.
+
+	When `failure_threshold` consecutive attempts have failed, the breaker opens
+	and every request going through it waits until `cooldown` seconds have
+	passed. The next attempt then probes the server: a success closes the
+	breaker, a failure opens it again.
+
+	The state of the breaker is kept in shared memory, so that a breaker
+	passed to worker processes when they start (e.g. through the initializer
+	arguments of a ProcessPoolExecutor) pauses the requests of all of them.
+	The time is read from the monotonic clock, which is system-wide.
+	"""
+
+	def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+		self.failure_threshold = failure_threshold
+		self.cooldown = cooldown
+		self._lock = multiprocessing.Lock()
+		self._failures = multiprocessing.RawValue("i", 0)
+		self._open_until = multiprocessing.RawValue("d", 0.0)
+
+	def wait_time(self) -> float:
+		with self._lock:
+			return max(0.0, self._open_until.value - time.monotonic())
+
+	def record_success(self) -> None:
+		with self._lock:
+			self._failures.value = 0
+
+	def record_failure(self) -> bool:
+		"""Record a failed attempt and return True if it opened the breaker."""
+
+		with self._lock:
+			self._failures.value += 1
+			if self._failures.value < self.failure_threshold:
+				return False
+			self._open_until.value = time.monotonic() + self.cooldown
+			# A single failure of the probing attempt opens the breaker again.
+			self._failures.value = self.failure_threshold - 1
+			return True
+
+
+class Retrier:
+	"""Run requests with retries, exponential backoff and a circuit breaker,
+	and count what happened.
+
+	Only transient failures are retried (see transient_error_info); other
+	errors are raised immediately. When all attempts have failed, the error of
+	the last attempt is raised.
+
+	Parameters
+	----------
+	policy : RetryPolicy, optional
+		Retry policy. Defaults to RetryPolicy().
+	breaker : CircuitBreaker, optional
+		Circuit breaker shared by all the requests of the retrier. Defaults to CircuitBreaker().
+	"""
+
+	def __init__(self, policy: Optional[RetryPolicy] = None, breaker: Optional[CircuitBreaker] = None):
+		self.policy = RetryPolicy() if policy is None else policy
+		self.breaker = CircuitBreaker() if breaker is None else breaker
+		self.stats = RetryStats()
+		self._lock = threading.Lock()
+
+	def call(self, func: Callable[[], T], description: str) -> T:
+		attempt = 0
+		while True:
+			self.wait(self.breaker.wait_time(), time.sleep)
+			self.count(requests=1)
+			try:
+				result = func()
+			except Exception as error:
+				delay = self.retry_delay(error, attempt, description)
+				if delay is None:
+					raise
+				self.wait(delay, time.sleep)
+				attempt += 1
+				continue
+			self.breaker.record_success()
+			return result
+
+	async def call_async(self, func: Callable[[], Awaitable[T]], description: str) -> T:
+		attempt = 0
+		while True:
+			await asyncio.sleep(self.wait(self.breaker.wait_time()))
+			self.count(requests=1)
+			try:
+				result = await func()
+			except Exception as error:
+				delay = self.retry_delay(error, attempt, description)
+				if delay is None:
+					raise
+				await asyncio.sleep(self.wait(delay))
+				attempt += 1
+				continue
+			self.breaker.record_success()
+			return result
+
+	def retry_delay(self, error: Exception, attempt: int, description: str) -> Optional[float]:
+		"""Return the delay before retrying after a failed attempt, or None if the error must be raised."""
+
+		transient, retry_after = transient_error_info(error, self.policy.retry_statuses)
+		if not transient:
+			return None
+		if self.breaker.record_failure():
+			self.count(breaker_trips=1)
+			warnings.warn(f"Too many consecutive failures, requests are paused for {self.breaker.cooldown:.0f} s.")
+		if attempt + 1 >= self.policy.max_attempts:
+			self.count(failures=1)
+			return None
+		if retry_after is None:
+			delay = self.policy.backoff(attempt)
+		else:
+			delay = min(retry_after, self.policy.max_retry_after)
+		self.count(retries=1)
+		warnings.warn(f"{description} failed ({type(error).__name__}: {error}), retrying in {delay:.1f} s.")
+		return delay
+
+	def wait(self, delay: float, sleep: Optional[Callable[[float], Any]] = None) -> float:
+		if delay > 0:
+			self.count(wait_time=delay)
+			if sleep is not None:
+				sleep(delay)
+		return delay
+
+	def count(self, **increments: float) -> None:
+		with self._lock:
+			self.stats.add(RetryStats(**increments))
+
+	def snapshot(self) -> RetryStats:
+		with self._lock:
+			return RetryStats(**{stat.name: getattr(self.stats, stat.name) for stat in fields(self.stats)})
+
+
+def transient_error_info(error: Exception, retry_statuses: frozenset[int] = DEFAULT_RETRY_STATUSES) -> Tuple[bool, Optional[float]]:
+	"""Tell whether an error is worth retrying.
+
+	Returns
+	-------
+	Whether the error is transient (retryable HTTP status, connection reset,
+	timeout, truncated response) and the delay in seconds requested by the
+	server's Retry-After header, if any.
+	"""
+
+	if isinstance(error, requests.HTTPError) and error.response is not None:
+		return error.response.status_code in retry_statuses, parse_retry_after(error.response.headers.get("Retry-After"))
+	if isinstance(error, httpx.HTTPStatusError):
+		return error.response.status_code in retry_statuses, parse_retry_after(error.response.headers.get("Retry-After"))
+	if isinstance(error, urllib.error.HTTPError):
+		return error.code in retry_statuses, parse_retry_after(error.headers.get("Retry-After"))
+	if isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+		return True, None
+	if isinstance(error, (httpx.TransportError, urllib.error.URLError, ConnectionError, TimeoutError, http.client.IncompleteRead)):
+		return True, None
+	match = ICOSCP_STATUS_PATTERN.search(str(error))
+	if match is not None:
+		return int(match.group(1)) in retry_statuses, None
+	return False, None
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+	"""Parse a Retry-After header given either in seconds or as an HTTP date."""
+
+	if value is None:
+		return None
+	try:
+		return max(0.0, float(value))
+	except ValueError:
+		pass
+	try:
+		date = parsedate_to_datetime(value)
+	except (TypeError, ValueError):
+		return None
+	if date.tzinfo is None:
+		date = date.replace(tzinfo=timezone.utc)
+	return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+_download_retrier: Optional[Retrier] = None
+
+
+def get_download_retrier() -> Retrier:
+	"""Return the module-level retrier of data object downloads, creating it on first use."""
+
+	global _download_retrier
+	if _download_retrier is None:
+		_download_retrier = Retrier()
+	return _download_retrier
+
+
+def set_download_retrier(retrier: Retrier) -> None:
+	global _download_retrier
+	_download_retrier = retrier
+
+
+def use_download_retry_policy(policy: RetryPolicy, breaker: Optional[CircuitBreaker] = None) -> None:
+	"""Replace the module-level download retrier by one following the policy,
+	e.g. when initializing a worker process. Worker processes given the
+	breaker of the main process's retrier share its state."""
+
+	set_download_retrier(Retrier(policy, breaker))
@@ -0,0 +1,195 @@
+import json
+import os
+import warnings
+from datetime import datetime
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+from sparql import SubmissionWindow
+from wdcgg_json import WdcggJSONEncoder
+
+
+MANIFEST_FILE = "manifest.jsonl"
+
+
+@dataclass
+class ManifestEntry:
+	"""Processed data object and its contribution to the metadata files.
+
+	Parameters
+	----------
+	url :               Data object's URL.
+	data_file :         Name of the data file written for the data object.
+	metadata :          Dataset metadata record of the data object (a dictionary when read from the manifest).
+	contacts :          Contact person records created while processing the data object.
+	contact_ids :       Person URI to contact ID mapping of the contacts created.
+	organizations :     Organization records created while processing the data object.
+	organization_ids :  Organization label to organization code mapping of the organizations created.
+	quarantined :       Whether the data object was quarantined because its metadata is invalid.
+	"""
+	url: str
+	data_file: str
+	metadata: Any
+	contacts: list[Any]
+	contact_ids: dict[str, str]
+	organizations: list[Any]
+	organization_ids: dict[str, str]
+	quarantined: bool = False
+
+
+class RunManifest:
+	"""Record of the data objects processed by an export, stored in the output directory.
+
+	The manifest is a JSON Lines file: a header with the submission window and
+	the data objects delivered by previous runs, one line per processed data
+	object, and a last line marking the run as complete. Lines are appended
+	as soon as a data object is processed, so that an interrupted run can be
+	resumed where it stopped. Only the entries read from the file are kept
+	in memory; those recorded by the current run are only written to it.
+
+	The files of a run are written to its delivery directory: the output
+	directory itself, or for incremental runs a subdirectory named after the
+	start of the run, so that each incremental delivery keeps its own files.
+	"""
+
+	def __init__(
+			self,
+			path: Path,
+			submission_window: SubmissionWindow,
+			delivered: set[str],
+			entries: list[ManifestEntry],
+			complete: bool,
+			delivery_dir: str = ""):
+		self.path = path
+		self.submission_window = submission_window
+		self.delivered = delivered
+		self.delivery_dir = delivery_dir
+		self.entries = entries
+		self.complete = complete
+		self.data_files = [entry.data_file for entry in entries if not entry.quarantined]
+		self._processed = set(entry.url for entry in entries)
+		self._quarantined = set(entry.url for entry in entries if entry.quarantined)
+
+	@staticmethod
+	def open(out_dir: Path, submission_window: SubmissionWindow, restart: bool = False, incremental: bool = False) -> "RunManifest":
+		"""Open the manifest of the output directory for a new run.
+
+		Parameters
+		----------
+		out_dir : Path
+			Output directory of the export.
+		submission_window : SubmissionWindow
+			Submission window of the run.
+		restart : bool
+			Ignore any existing manifest and process all data objects again.
+		incremental : bool
+			Skip the data objects processed by previous complete runs and only
+			deliver the newly submitted ones.
+
+		Returns
+		-------
+		A manifest resuming the previous run if it was interrupted with the same
+		submission window, otherwise a new, empty manifest.
+		"""
+
+		path = out_dir / MANIFEST_FILE
+		previous = None if restart else RunManifest.read(path)
+		if previous is not None and not previous.complete and previous.has_window(submission_window):
+			return previous
+		delivered: set[str] = set()
+		if previous is not None and incremental:
+			# Quarantined data objects were not delivered and are processed again.
+			delivered = previous.delivered | (previous._processed - previous._quarantined)
+		elif previous is not None and not previous.has_window(submission_window):
+			warnings.warn(f"Manifest {path} belongs to another submission window and is replaced.")
+		delivery_dir = datetime.now().strftime("delivery_%Y%m%dT%H%M%S") if incremental else ""
+		manifest = RunManifest(path, submission_window, delivered, [], False, delivery_dir)
+		manifest.rewrite()
+		return manifest
+
+	@staticmethod
+	def read(path: Path) -> Optional["RunManifest"]:
+		if not path.exists():
+			return None
+		with open(path, "r") as file:
+			lines = file.read().split("\n")
+		try:
+			header = json.loads(lines[0])
+		except json.JSONDecodeError:
+			return None
+		entries: list[ManifestEntry] = []
+		complete = False
+		truncated = False
+		for line in lines[1:]:
+			if line == "": continue
+			try:
+				record = json.loads(line)
+			except json.JSONDecodeError:
+				# Last line of a run interrupted while writing to the manifest.
+				truncated = True
+				break
+			if record.get("complete"):
+				complete = True
+			else:
+				entries.append(ManifestEntry(**record))
+		submission_window = SubmissionWindow(
+			datetime.fromisoformat(header["submission_window"]["start"]),
+			datetime.fromisoformat(header["submission_window"]["end"])
+		)
+		manifest = RunManifest(path, submission_window, set(header["delivered"]), entries, complete, header.get("delivery_dir", ""))
+		if truncated:
+			manifest.rewrite()
+		return manifest
+
+	@property
+	def delivery_directory(self) -> Path:
+		return self.path.parent / self.delivery_dir
+
+	def has_window(self, submission_window: SubmissionWindow) -> bool:
+		return self.submission_window == submission_window
+
+	def is_processed(self, url: str) -> bool:
+		return url in self._processed or url in self.delivered
+
+	def record(self, entry: ManifestEntry) -> None:
+		"""Append a processed data object to the manifest file.
+
+		The entry itself is not kept in memory, only its URL and data file name.
+		"""
+
+		if entry.quarantined:
+			self._quarantined.add(entry.url)
+		else:
+			self.data_files.append(entry.data_file)
+		self._processed.add(entry.url)
+		self.append_line(entry)
+
+	def mark_complete(self) -> None:
+		self.complete = True
+		self.append_line({"complete": True})
+
+	def rewrite(self) -> None:
+		tmp_path = self.path.with_suffix(".tmp")
+		with open(tmp_path, "w") as file:
+			file.write(json.dumps(self.header()) + "\n")
+			for entry in self.entries:
+				file.write(json.dumps(entry, cls=WdcggJSONEncoder) + "\n")
+			if self.complete:
+				file.write(json.dumps({"complete": True}) + "\n")
+		os.replace(tmp_path, self.path)
+
+	def header(self) -> dict[str, Any]:
+		return {
+			"submission_window": {
+				"start": self.submission_window.start.isoformat(),
+				"end": self.submission_window.end.isoformat()
+			},
+			"delivered": sorted(self.delivered),
+			"delivery_dir": self.delivery_dir
+		}
+
+	def append_line(self, content: Any) -> None:
+		with open(self.path, "a") as file:
+			file.write(json.dumps(content, cls=WdcggJSONEncoder) + "\n")
+			file.flush()
+			os.fsync(file.fileno())
@@ -1,12 +1,25 @@
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import requests
+from requests.adapters import HTTPAdapter
 from dataclasses import dataclass
-from typing import Optional, Tuple, Any
+from typing import Optional, Tuple, Any, Iterator
+from sparql_cache import SparqlCache
+from retry import Retrier
 
 
 SPARQL_ENDPOINT = "https://meta.icos-cp.eu/sparql"
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 300.0
+DEFAULT_PAGE_SIZE = 10000
+TSV_MEDIA_TYPE = "text/tab-separated-values"
+OBJECT_SPEC_PREFIX = "http://meta.icos-cp.eu/resources/cpmeta/"
+XSD = "http://www.w3.org/2001/XMLSchema#"
+TSV_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", '"': '"', "'": "'", "\\": "\\"}
 
 
 @dataclass
@@ -20,13 +33,252 @@ class SparqlResults:
 	bindings: list[dict[str, dict[str, str | int | float]]]
 
 
-def run_sparql_select_query(query: str) -> Optional[SparqlResults]:
+class SparqlClient:
+	"""HTTP client for the ICOS Carbon Portal SPARQL endpoint.
+
+	All queries go through one pooled, keep-alive `requests.Session`, so that
+	consecutive queries reuse already established TCP/TLS connections instead
+	of performing a new handshake every time.
+
+	Parameters
+	----------
+	endpoint : str
+		URL of the SPARQL endpoint.
+	pool_size : int
+		Maximum number of connections kept alive in the pool.
+	connect_timeout : float
+		Timeout in seconds for establishing a connection.
+	read_timeout : float
+		Timeout in seconds for waiting on data from the server.
+	cache : SparqlCache, optional
+		Persistent cache of query results. If None, every query hits the endpoint.
+	retrier : Retrier, optional
+		Retries of the queries failing because of a transient error. Defaults to Retrier().
+	"""
+
+	def __init__(
+			self,
+			endpoint: str = SPARQL_ENDPOINT,
+			pool_size: int = DEFAULT_POOL_SIZE,
+			connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+			read_timeout: float = DEFAULT_READ_TIMEOUT,
+			cache: Optional[SparqlCache] = None,
+			retrier: Optional[Retrier] = None):
+		self.endpoint = endpoint
+		self.cache = cache
+		self.retrier = Retrier() if retrier is None else retrier
+		self.timeout = (connect_timeout, read_timeout)
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+		self.session.headers.update({
+			"Accept": "application/sparql-results+json",
+			"Accept-Encoding": "gzip, deflate"
+		})
+
+	def select(self, query: str, kind: str = "default") -> SparqlResults:
+		"""Run a SPARQL SELECT query.
+
+		Parameters
+		----------
+		query : str
+			SPARQL query.
+		kind : str
+			Kind of query, which determines how long its results are cached.
+
+		Returns
+		-------
+			The results of the query in the form of a SparqlResults object containing
+			the list of parameters and the list of bindings.
+			If the HTTP response's status code is not 200 after all retries, raises an HTTPError.
+		"""
+
+		cached = self.cache.get(query, kind) if self.cache is not None else None
+		if cached is not None:
+			return parse_sparql_json(cached)
+		resp = self.retrier.call(lambda: self.get(query), "SPARQL query")
+		if self.cache is not None:
+			self.cache.put(query, kind, resp.text)
+		return parse_sparql_json(resp.text)
+
+	def iter_select(self, query: str, kind: str = "default") -> Tuple[list[str], Iterator[dict[str, Any]]]:
+		"""Run a SPARQL SELECT query and stream its results row by row.
+
+		Results are requested in the SPARQL TSV format and parsed line by line
+		as they arrive, with literals converted according to their datatype
+		(see parse_tsv_term).
+
+		Parameters
+		----------
+		query : str
+			SPARQL query.
+		kind : str
+			Kind of query, which determines how long its results are cached.
+
+		Returns
+		-------
+			The list of parameters and an iterator over the rows, which are
+			dictionaries from parameter to value (None if unbound).
+			If the HTTP response's status code is not 200 after all retries, raises an HTTPError.
+		"""
+
+		cache_query = f"#format={TSV_MEDIA_TYPE}\n{query}"
+		cached = self.cache.get(cache_query, kind) if self.cache is not None else None
+		if cached is not None:
+			lines: Iterator[str] = iter(cached.split("\n"))
+		else:
+			resp = self.retrier.call(lambda: self.get(query, TSV_MEDIA_TYPE, stream=True), "SPARQL query")
+			resp.encoding = "utf-8"
+			lines = self.stream_lines(resp, cache_query, kind)
+		params = [param.lstrip("?$") for param in next(lines, "").split("\t") if param != ""]
+		return params, (parse_tsv_row(params, line) for line in lines if line != "")
+
+	def stream_lines(self, resp: requests.Response, cache_query: str, kind: str) -> Iterator[str]:
+		"""Yield the lines of a streamed response, storing the complete response in the cache."""
+
+		cache = self.cache
+		to_cache: Optional[list[str]] = [] if cache is not None and kind in cache.ttls else None
+		with resp:
+			for line in resp.iter_lines(decode_unicode=True):
+				if to_cache is not None: to_cache.append(line)
+				yield line
+		if cache is not None and to_cache is not None:
+			cache.put(cache_query, kind, "\n".join(to_cache))
+
+	def get(self, query: str, accept: Optional[str] = None, stream: bool = False) -> requests.Response:
+		headers = None if accept is None else {"Accept": accept}
+		resp = self.session.get(self.endpoint, params={"query": query}, headers=headers, timeout=self.timeout, stream=stream)
+		try:
+			self.check_status(resp, query)
+		except requests.HTTPError:
+			resp.close()
+			raise
+		return resp
+
+	def check_status(self, resp: requests.Response, query: str) -> None:
+		if resp.status_code == 200:
+			return
+		elif not resp.ok:
+			raise requests.HTTPError(
+				f"Error {resp.status_code} when running SPARQL query\n{query}\n"
+				f"at SPARQL endpoint {self.endpoint}.\nReason: {resp.reason}",
+				response=resp
+			)
+		else:
+			raise requests.HTTPError(
+				f"HTTP status code {resp.status_code} when running SPARQL query"
+				f"\n{query}\n at SPARQL endpoint {self.endpoint}.\nReason: {resp.reason}",
+				response=resp
+			)
+
+	def close(self) -> None:
+		self.session.close()
+
+
+def parse_sparql_json(text: str) -> SparqlResults:
+	content = json.loads(text)
+	return SparqlResults(
+		params=content["head"]["vars"],
+		bindings=content["results"]["bindings"]
+	)
+
+
+def parse_tsv_row(params: list[str], line: str) -> dict[str, Any]:
+	return dict(zip(params, map(parse_tsv_term, line.split("\t"))))
+
+
+def parse_tsv_term(term: str) -> Any:
+	"""Convert an RDF term in SPARQL TSV syntax to a Python value.
+
+	Returns
+	-------
+	None for an unbound value, the URI for an IRI, a datetime for xsd:dateTime,
+	an int for xsd:integer and derived types, a float for xsd:double, xsd:float
+	and xsd:decimal, a bool for xsd:boolean and a string otherwise.
+	"""
+
+	if term == "":
+		return None
+	if term[0] == "<":
+		return term[1:-1]
+	if term[0] != '"':
+		# Numbers and booleans may be written without quotes or datatype.
+		if term in ("true", "false"):
+			return term == "true"
+		try:
+			return int(term)
+		except ValueError:
+			try:
+				return float(term)
+			except ValueError:
+				return term
+	end = term.rindex('"')
+	lexical = unescape_tsv_string(term[1:end])
+	suffix = term[end + 1:]
+	if not suffix.startswith("^^"):
+		return lexical
+	datatype = suffix[3:-1].removeprefix(XSD)
+	if datatype == "dateTime":
+		return datetime.fromisoformat(lexical)
+	elif datatype in ("integer", "int", "long", "short", "byte", "nonNegativeInteger", "positiveInteger"):
+		return int(lexical)
+	elif datatype in ("double", "float", "decimal"):
+		return float(lexical)
+	elif datatype == "boolean":
+		return lexical in ("true", "1")
+	else:
+		return lexical
+
+
+def unescape_tsv_string(value: str) -> str:
+	if "\\" not in value:
+		return value
+	chars: list[str] = []
+	escaped = False
+	for char in value:
+		if escaped:
+			chars.append(TSV_ESCAPES.get(char, "\\" + char))
+			escaped = False
+		elif char == "\\":
+			escaped = True
+		else:
+			chars.append(char)
+	return "".join(chars)
+
+
+_default_client: Optional[SparqlClient] = None
+
+
+def get_sparql_client() -> SparqlClient:
+	"""Return the module-level SPARQL client, creating it on first use."""
+
+	global _default_client
+	if _default_client is None:
+		_default_client = SparqlClient()
+	return _default_client
+
+
+def set_sparql_client(client: SparqlClient) -> None:
+	"""Replace the module-level SPARQL client used by the run_sparql_select_query* functions."""
+
+	global _default_client
+	if _default_client is not None and _default_client is not client:
+		_default_client.close()
+	_default_client = client
+
+
+def run_sparql_select_query(query: str, client: Optional[SparqlClient]=None, kind: str="default") -> Optional[SparqlResults]:
 	"""Run a SPARQL SELECT query on the ICOS Carbon Portal SPARQL endpoint.
 	
 	Parameters
 	----------
 	query : str
 		SPARQL query.
+	client : SparqlClient, optional
+		Client to run the query with. Defaults to the module-level client.
+	kind : str
+		Kind of query, which determines how long its results are cached.
 	
 	Returns
 	-------
@@ -35,27 +287,111 @@ def run_sparql_select_query(query: str) -> Optional[SparqlResults]:
 		If the HTTP response's status code is not 200, returns an HTTPError.
 	"""
 
-	resp = requests.get(SPARQL_ENDPOINT, params={"query": query})
-	if resp.status_code == 200:
-		content = json.loads(resp.text)
-		return SparqlResults(
-			params=content["head"]["vars"],
-			bindings=content["results"]["bindings"]
-		)
-	elif not resp.ok:
-		raise requests.HTTPError(
-			f"Error {resp.status_code} when running SPARQL query\n{query}\n"
-			f"at SPARQL endpoint {SPARQL_ENDPOINT}.\nReason: {resp.reason}"
-		)
-	else:
-		raise requests.HTTPError(
-			f"HTTP status code {resp.status_code} when running SPARQL query"
-			f"\n{query}\n at SPARQL endpoint {SPARQL_ENDPOINT}.\nReason: {resp.reason}"
-		)
+	return (client or get_sparql_client()).select(query, kind)
 
 
-def run_sparql_select_query_single_param(query: str, result_type: Optional[type]=None) -> list[Any]:
-	sparql_results = run_sparql_select_query(query)
+def run_sparql_select_query_single_param(query: str, result_type: Optional[type]=None, client: Optional[SparqlClient]=None, kind: str="default") -> list[Any]:
+	return single_param_values(run_sparql_select_query(query, client, kind), query, result_type)
+
+
+def run_sparql_select_query_multi_params(query: str, result_type: Optional[type]=None, client: Optional[SparqlClient]=None, kind: str="default") -> Optional[dict[str, list[str | int | float]]]:
+	return multi_params_values(run_sparql_select_query(query, client, kind), query, result_type)
+
+
+def iter_sparql_select_query(query: str, client: Optional[SparqlClient]=None, kind: str="default") -> Iterator[dict[str, Any]]:
+	"""Run a SPARQL SELECT query and yield its rows as they arrive, with typed values.
+
+	See SparqlClient.iter_select for the conversion of values.
+	"""
+
+	_, rows = (client or get_sparql_client()).iter_select(query, kind)
+	yield from rows
+
+
+def iter_sparql_select_query_paged(
+		query: str,
+		page_size: int = DEFAULT_PAGE_SIZE,
+		prefetch: int = 1,
+		client: Optional[SparqlClient] = None,
+		kind: str = "default") -> Iterator[dict[str, Any]]:
+	"""Run a SPARQL SELECT query page by page with LIMIT/OFFSET and yield its rows
+	as they arrive, with typed values.
+
+	The query must have an ORDER BY clause fully determining the order of the
+	results, otherwise pages may overlap or miss rows. Paging stops at the
+	first page with less than `page_size` rows.
+
+	Parameters
+	----------
+	query : str
+		SPARQL query, without LIMIT nor OFFSET.
+	page_size : int
+		Maximum number of rows per page. If not positive, the results are
+		fetched in a single response.
+	prefetch : int
+		Number of pages fetched concurrently ahead of the rows being consumed.
+		With 1, pages are fetched one after the other and streamed.
+	client : SparqlClient, optional
+		Client to run the query with. Defaults to the module-level client.
+	kind : str
+		Kind of query, which determines how long the pages are cached.
+	"""
+
+	sparql_client = client or get_sparql_client()
+	if page_size <= 0:
+		yield from iter_sparql_select_query(query, sparql_client, kind)
+		return
+	if prefetch <= 1:
+		page = 0
+		while True:
+			n_rows = 0
+			for row in iter_sparql_select_query(paged_query(query, page_size, page), sparql_client, kind):
+				n_rows += 1
+				yield row
+			if n_rows < page_size:
+				return
+			page += 1
+
+	def fetch_page(page: int) -> list[dict[str, Any]]:
+		return list(iter_sparql_select_query(paged_query(query, page_size, page), sparql_client, kind))
+
+	with ThreadPoolExecutor(max_workers=prefetch) as executor:
+		pending = deque(executor.submit(fetch_page, page) for page in range(prefetch))
+		next_page = prefetch
+		while pending:
+			rows = pending.popleft().result()
+			yield from rows
+			if len(rows) < page_size:
+				for future in pending:
+					future.cancel()
+				return
+			pending.append(executor.submit(fetch_page, next_page))
+			next_page += 1
+
+
+def paged_query(query: str, page_size: int, page: int) -> str:
+	return f"{query.rstrip()}\nLIMIT {page_size} OFFSET {page * page_size}\n"
+
+
+def run_sparql_select_query_columns(query: str, client: Optional[SparqlClient]=None, kind: str="default") -> dict[str, list[Any]]:
+	"""Run a SPARQL SELECT query and build one list of typed values per parameter
+	in a single pass over the streamed results.
+
+	Returns
+	-------
+	A dictionary from parameter to the list of its values (None where unbound).
+	"""
+
+	params, rows = (client or get_sparql_client()).iter_select(query, kind)
+	results: dict[str, list[Any]] = {param: [] for param in params}
+	columns = list(results.items())
+	for row in rows:
+		for param, column in columns:
+			column.append(row[param])
+	return results
+
+
+def single_param_values(sparql_results: Optional[SparqlResults], query: str, result_type: Optional[type]=None) -> list[Any]:
 	if sparql_results is None:
 		return []
 	if len(sparql_results.params) == 1:
@@ -72,17 +408,15 @@ def run_sparql_select_query_single_param(query: str, result_type: Optional[type]
 		)
 
 
-def run_sparql_select_query_multi_params(query: str, result_type: Optional[type]=None) -> Optional[dict[str, list[str | int | float]]]:
-	sparql_results = run_sparql_select_query(query)
+def multi_params_values(sparql_results: Optional[SparqlResults], query: str, result_type: Optional[type]=None) -> Optional[dict[str, list[str | int | float]]]:
 	if sparql_results is None:
 		return {}
 	if len(sparql_results.params) > 1:
-		results: dict[str, list[str | int | float]] = {}
-		for param in sparql_results.params:
-			results[param] = []
-			for binding in sparql_results.bindings:
-				value = check_value_type(binding[param]["value"], result_type, query)
-				results[param].append(value)
+		results: dict[str, list[str | int | float]] = {param: [] for param in sparql_results.params}
+		columns = list(results.items())
+		for binding in sparql_results.bindings:
+			for param, column in columns:
+				column.append(check_value_type(binding[param]["value"], result_type, query))
 		return results
 	else:
 		raise TypeError(
@@ -124,6 +458,37 @@ SELECT ?dobj WHERE {
 	FILTER( ?submTime >= '%s'^^xsd:dateTime && ?submTime <= '%s'^^xsd:dateTime )
 	FILTER( ?stationClass = "1" || ?stationClass = "2" )
 }
+ORDER BY ?submTime ?dobj
+	""" % submission_window_to_utc_str(submission_window, "%Y-%m-%dT%H:%M:%SZ")
+
+
+def obspack_dobj_info_query(submission_window: SubmissionWindow) -> str:
+	"""Query the metadata needed for the WDCGG export of all Obspack time series
+	submitted during the submission window.
+
+	cpmeta:hasBiblioInfo is computed by the metadata server and contains the
+	citation string and the authors of the data object as JSON.
+	"""
+
+	return """
+PREFIX cpmeta: <http://meta.icos-cp.eu/ontologies/cpmeta/>
+PREFIX prov: <http://www.w3.org/ns/prov#>
+PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+SELECT ?dobj ?fileName ?station ?samplingHeight ?keywords ?biblioInfo WHERE {
+	VALUES ?spec { <http://meta.icos-cp.eu/resources/cpmeta/ObspackTimeSerieResult> <http://meta.icos-cp.eu/resources/cpmeta/ObspackCH4TimeSeriesResult> <http://meta.icos-cp.eu/resources/cpmeta/ObspackN2oTimeSeriesResult> <http://meta.icos-cp.eu/resources/cpmeta/ObspackCOTimeSeriesResult> }
+	?dobj cpmeta:hasObjectSpec ?spec .
+	?dobj cpmeta:hasName ?fileName .
+	?dobj cpmeta:wasAcquiredBy ?acquisition .
+	?acquisition prov:wasAssociatedWith ?station .
+	?station cpmeta:hasStationClass ?stationClass .
+	?dobj cpmeta:wasSubmittedBy/prov:endedAtTime ?submTime .
+	OPTIONAL { ?acquisition cpmeta:hasSamplingHeight ?samplingHeight }
+	OPTIONAL { ?spec cpmeta:hasKeywords ?keywords }
+	OPTIONAL { ?dobj cpmeta:hasBiblioInfo ?biblioInfo }
+	FILTER( ?submTime >= '%s'^^xsd:dateTime && ?submTime <= '%s'^^xsd:dateTime )
+	FILTER( ?stationClass = "1" || ?stationClass = "2" )
+}
+ORDER BY ?submTime ?dobj
 	""" % submission_window_to_utc_str(submission_window, "%Y-%m-%dT%H:%M:%SZ")
 
 
@@ -139,10 +504,32 @@ SELECT ?doi WHERE {
 	?dobj cpmeta:hasDoi ?doi .
 	FILTER( ?submTime >= '%s'^^xsd:dateTime && ?submTime <= '%s'^^xsd:dateTime )
 }
-ORDER BY DESC(?submTime)
+ORDER BY DESC(?submTime) ?dobj
 	""" % (object_spec, *submission_window_to_utc_str(submission_window, "%Y-%m-%dT%H:%M:%SZ"))
 
 
+def obspack_releases_query(object_specs: list[str], submission_window: SubmissionWindow) -> str:
+	"""Query the DOIs of the Obspack releases of several object specifications
+	submitted during the submission window, the latest first for each specification."""
+
+	return """
+PREFIX cpmeta: <http://meta.icos-cp.eu/ontologies/cpmeta/>
+PREFIX prov: <http://www.w3.org/ns/prov#>
+PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+SELECT ?spec ?doi WHERE {
+	VALUES ?spec { %s }
+	?dobj cpmeta:hasObjectSpec ?spec .
+	?dobj cpmeta:wasSubmittedBy/prov:endedAtTime ?submTime .
+	?dobj cpmeta:hasDoi ?doi .
+	FILTER( ?submTime >= '%s'^^xsd:dateTime && ?submTime <= '%s'^^xsd:dateTime )
+}
+ORDER BY ?spec DESC(?submTime) ?dobj
+	""" % (
+		" ".join(f"<{OBJECT_SPEC_PREFIX}{object_spec}>" for object_spec in object_specs),
+		*submission_window_to_utc_str(submission_window, "%Y-%m-%dT%H:%M:%SZ")
+	)
+
+
 def instrument_query(instrument_atc_id: int) -> str:
 	return """
 PREFIX cpmeta: <http://meta.icos-cp.eu/ontologies/cpmeta/>
@@ -156,6 +543,27 @@ SELECT ?instrumentInfo WHERE {
 	""" % instrument_atc_id
 
 
+def atc_instruments_query(instrument_atc_ids: Optional[list[int]] = None) -> str:
+	"""Query the labels of the given ATC instruments, or of all ATC instruments if no ID is given."""
+
+	if instrument_atc_ids is None:
+		selection = 'FILTER(STRSTARTS(STR(?instrument), "http://meta.icos-cp.eu/resources/instruments/ATC_"))'
+	else:
+		selection = "VALUES ?instrument { %s }" % " ".join(
+			f"<http://meta.icos-cp.eu/resources/instruments/ATC_{atc_id}>" for atc_id in instrument_atc_ids
+		)
+	return """
+PREFIX cpmeta: <http://meta.icos-cp.eu/ontologies/cpmeta/>
+SELECT ?instrument ?instrumentInfo WHERE {
+	?instrument cpmeta:hasModel ?model .
+	?instrument cpmeta:hasSerialNumber ?serialNumber .
+	?instrument cpmeta:hasVendor/cpmeta:hasName ?vendorName .
+	%s
+	BIND(concat(?vendorName, ", ", ?model, ", ", ?serialNumber) AS ?instrumentInfo)
+}
+	""" % selection
+
+
 def contributor_roles_query(contributor_uri: str, station_uri: str) -> str:
 	return """
 PREFIX cpmeta: <http://meta.icos-cp.eu/ontologies/cpmeta/>
@@ -168,4 +576,19 @@ SELECT ?role WHERE {
 	?membership cpmeta:atOrganization ?organization .
 	?membership cpmeta:hasRole/rdfs:label ?role .
 }
-	""" % (contributor_uri, station_uri)
\ No newline at end of file
+	""" % (contributor_uri, station_uri)
+
+def contributor_roles_bulk_query(contributor_station_pairs: list[Tuple[str, str]]) -> str:
+	values = "\n\t\t".join(f"(<{contributor}> <{station}>)" for contributor, station in contributor_station_pairs)
+	return """
+PREFIX cpmeta: <http://meta.icos-cp.eu/ontologies/cpmeta/>
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+SELECT ?contributor ?organization ?role WHERE {
+	VALUES (?contributor ?organization) {
+		%s
+	}
+	?contributor cpmeta:hasMembership ?membership .
+	?membership cpmeta:atOrganization ?organization .
+	?membership cpmeta:hasRole/rdfs:label ?role .
+}
+	""" % values
@@ -0,0 +1,123 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+
+DEFAULT_CACHE_FILE = Path.home() / ".cache" / "icos_to_wdcgg" / "sparql_cache.sqlite"
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+DAY = 24 * 3600
+# Time to live, in seconds, of the cached results of each kind of query.
+# Queries of a kind that is not listed here are not cached.
+DEFAULT_TTLS: dict[str, float] = {
+	"dobj_list": 3600,
+	"obspack_release": DAY,
+	"contributor_roles": 7 * DAY,
+	"instrument": 30 * DAY
+}
+
+
+def normalize_query(query: str) -> str:
+	return " ".join(query.split())
+
+
+def query_key(query: str) -> str:
+	return hashlib.sha256(normalize_query(query).encode()).hexdigest()
+
+
+class SparqlCache:
+	"""Persistent cache of SPARQL query results stored in an SQLite file.
+
+	Results are keyed by the SHA-256 hash of the normalized query text and
+	expire according to the time to live of their kind of query. When the
+	total size of the cached results exceeds the size limit, the least
+	recently used entries are evicted.
+
+	Parameters
+	----------
+	path : Path
+		Path to the SQLite file, created if it does not exist.
+	ttls : dict[str, float], optional
+		Time to live in seconds for each kind of query.
+	max_size : int
+		Maximum total size in bytes of the cached results.
+	"""
+
+	def __init__(self, path: Path = DEFAULT_CACHE_FILE, ttls: Optional[dict[str, float]] = None, max_size: int = DEFAULT_MAX_SIZE):
+		path.parent.mkdir(parents=True, exist_ok=True)
+		self.ttls = DEFAULT_TTLS if ttls is None else ttls
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+		self._conn = sqlite3.connect(path, check_same_thread=False)
+		self._conn.execute(
+			"CREATE TABLE IF NOT EXISTS results ("
+			"key TEXT PRIMARY KEY, kind TEXT NOT NULL, content TEXT NOT NULL, "
+			"size INTEGER NOT NULL, stored_at REAL NOT NULL, last_access REAL NOT NULL)"
+		)
+		self._conn.commit()
+
+	def get(self, query: str, kind: str) -> Optional[str]:
+		"""Return the cached response to the query, or None if missing or expired."""
+
+		ttl = self.ttls.get(kind)
+		if ttl is None:
+			return None
+		key = query_key(query)
+		now = time.time()
+		with self._lock:
+			row = self._conn.execute(
+				"SELECT content, stored_at FROM results WHERE key = ?", (key,)
+			).fetchone()
+			if row is None or now - row[1] > ttl:
+				self.misses += 1
+				return None
+			self._conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+			self._conn.commit()
+			self.hits += 1
+			return row[0]
+
+	def put(self, query: str, kind: str, content: str) -> None:
+		if kind not in self.ttls:
+			return
+		now = time.time()
+		with self._lock:
+			self._conn.execute(
+				"INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+				(query_key(query), kind, content, len(content), now, now)
+			)
+			self._evict()
+			self._conn.commit()
+
+	def invalidate(self, kind: Optional[str] = None) -> None:
+		"""Remove the cached results of one kind of query, or of all queries."""
+
+		with self._lock:
+			if kind is None:
+				self._conn.execute("DELETE FROM results")
+			else:
+				self._conn.execute("DELETE FROM results WHERE kind = ?", (kind,))
+			self._conn.commit()
+
+	def purge(self) -> None:
+		self.invalidate()
+		with self._lock:
+			self._conn.execute("VACUUM")
+
+	def close(self) -> None:
+		with self._lock:
+			self._conn.close()
+
+	def _evict(self) -> None:
+		if self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0] <= self.max_size:
+			return
+		total = 0
+		rows = self._conn.execute("SELECT key, size FROM results ORDER BY last_access DESC").fetchall()
+		for n, (_, size) in enumerate(rows):
+			total += size
+			if total > self.max_size:
+				self._conn.executemany("DELETE FROM results WHERE key = ?", [(key,) for key, _ in rows[n:]])
+				break
@@ -0,0 +1,154 @@
+import csv
+import os
+import pickle
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+
+STATION_FILE = Path(__file__).parent / "station.csv"
+ADDITIONAL_STATIONS_FILE = Path(__file__).parent / "additional_stations.csv"
+DEFAULT_INDEX_FILE = Path.home() / ".cache" / "icos_to_wdcgg" / "station_index.pickle"
+INDEX_VERSION = 1
+
+
+@dataclass(frozen=True)
+class StationEntry:
+	four_digit_id: str
+	gaw_id: str
+	wdcgg_id: str
+	wigos_id: str
+	name: str
+
+
+class StationRegistry:
+	"""Lookup of the WDCGG station list by GAW ID, WDCGG ID or old four-digit WDCGG ID.
+
+	The station list is the CSV file downloaded from WDCGG. Stations that are
+	missing from it, or listed without GAW ID, can be added to the additional
+	stations file, which has the same columns; its entries are only used for
+	GAW IDs that the station list does not contain.
+
+	Parameters
+	----------
+	entries : list[StationEntry]
+		Stations of the registry. For duplicated IDs, the first entry wins.
+	"""
+
+	def __init__(self, entries: list[StationEntry]):
+		self.entries = entries
+		self._by_gaw_id: dict[str, StationEntry] = {}
+		self._by_wdcgg_id: dict[str, StationEntry] = {}
+		self._by_four_digit_id: dict[str, StationEntry] = {}
+		for entry in entries:
+			if entry.gaw_id != "": self._by_gaw_id.setdefault(entry.gaw_id, entry)
+			if entry.wdcgg_id != "": self._by_wdcgg_id.setdefault(entry.wdcgg_id, entry)
+			if entry.four_digit_id != "": self._by_four_digit_id.setdefault(entry.four_digit_id, entry)
+
+	def __contains__(self, gaw_id: str) -> bool:
+		return gaw_id in self._by_gaw_id
+
+	def by_gaw_id(self, gaw_id: str) -> Optional[StationEntry]:
+		return self._by_gaw_id.get(gaw_id)
+
+	def by_wdcgg_id(self, wdcgg_id: str) -> Optional[StationEntry]:
+		return self._by_wdcgg_id.get(wdcgg_id)
+
+	def by_four_digit_id(self, four_digit_id: str) -> Optional[StationEntry]:
+		return self._by_four_digit_id.get(four_digit_id)
+
+	@staticmethod
+	def from_csv(station_file: Path = STATION_FILE, additional_file: Optional[Path] = ADDITIONAL_STATIONS_FILE) -> "StationRegistry":
+		"""Parse the station list and the additional stations file."""
+
+		entries = read_station_file(station_file)
+		if additional_file is not None and additional_file.exists():
+			gaw_ids = set(entry.gaw_id for entry in entries)
+			entries += [entry for entry in read_station_file(additional_file) if entry.gaw_id not in gaw_ids]
+		return StationRegistry(entries)
+
+	@staticmethod
+	def load(
+			station_file: Path = STATION_FILE,
+			additional_file: Optional[Path] = ADDITIONAL_STATIONS_FILE,
+			index_file: Optional[Path] = DEFAULT_INDEX_FILE) -> "StationRegistry":
+		"""Load the registry from its precompiled index, which is rebuilt from
+		the CSV files when one of them changed since the index was written.
+
+		If index_file is None, the CSV files are parsed every time.
+		"""
+
+		sources = source_signature(station_file, additional_file)
+		if index_file is not None:
+			try:
+				with open(index_file, "rb") as file:
+					index = pickle.load(file)
+				if index["version"] == INDEX_VERSION and index["sources"] == sources:
+					return StationRegistry([StationEntry(*fields) for fields in index["entries"]])
+			except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+				pass
+		registry = StationRegistry.from_csv(station_file, additional_file)
+		if index_file is not None:
+			registry.write_index(index_file, sources)
+		return registry
+
+	def write_index(self, index_file: Path, sources: list[tuple]) -> None:
+		index = {
+			"version": INDEX_VERSION,
+			"sources": sources,
+			"entries": [
+				(entry.four_digit_id, entry.gaw_id, entry.wdcgg_id, entry.wigos_id, entry.name)
+				for entry in self.entries
+			]
+		}
+		try:
+			index_file.parent.mkdir(parents=True, exist_ok=True)
+			with tempfile.NamedTemporaryFile(dir=index_file.parent, delete=False) as tmp_file:
+				pickle.dump(index, tmp_file, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(tmp_file.name, index_file)
+		except OSError:
+			# The index only speeds up loading, the registry can be used without it.
+			pass
+
+
+def read_station_file(path: Path) -> list[StationEntry]:
+	with open(path, "r", newline="", encoding="utf-8") as file:
+		return [
+			StationEntry(
+				four_digit_id=row["No"].strip(),
+				gaw_id=row["GAW ID"].strip(),
+				wdcgg_id=row["WDCGG ID"].strip(),
+				wigos_id=(row.get("WIGOS ID") or "").strip(),
+				name=(row.get("Name") or "").strip()
+			)
+			for row in csv.DictReader(file)
+		]
+
+
+def source_signature(*paths: Optional[Path]) -> list[tuple]:
+	signature = []
+	for path in paths:
+		if path is None or not path.exists():
+			signature.append((str(path), None, None))
+		else:
+			stat = path.stat()
+			signature.append((str(path.resolve()), stat.st_mtime_ns, stat.st_size))
+	return signature
+
+
+_default_registry: Optional[StationRegistry] = None
+
+
+def get_station_registry() -> StationRegistry:
+	"""Return the module-level station registry, loading it on first use."""
+
+	global _default_registry
+	if _default_registry is None:
+		_default_registry = StationRegistry.load()
+	return _default_registry
+
+
+def set_station_registry(registry: StationRegistry) -> None:
+	global _default_registry
+	_default_registry = registry
@@ -0,0 +1,94 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+import pytest
+import async_sparql
+from async_sparql import run_sparql_select_queries_concurrently
+
+
+RESPONSE_DELAY = 0.1
+RESPONSE = json.dumps({
+	"head": {"vars": ["s", "o"]},
+	"results": {"bindings": [{"s": {"type": "uri", "value": "http://x/s"}, "o": {"type": "literal", "value": "o"}}]}
+}).encode()
+
+
+class StandInEndpoint(ThreadingHTTPServer):
+	"""Local SPARQL endpoint answering every query after a delay, and recording
+	when requests start, how many run at the same time and from which connection."""
+
+	daemon_threads = True
+
+	def __init__(self) -> None:
+		super().__init__(("127.0.0.1", 0), StandInHandler)
+		self.lock = threading.Lock()
+		self.starts: list[float] = []
+		self.client_ports: set[int] = set()
+		self.in_flight = 0
+		self.max_in_flight = 0
+
+	@property
+	def url(self) -> str:
+		return f"http://127.0.0.1:{self.server_port}/sparql"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	server: StandInEndpoint
+
+	def do_GET(self) -> None:
+		with self.server.lock:
+			self.server.starts.append(time.monotonic())
+			self.server.client_ports.add(self.client_address[1])
+			self.server.in_flight += 1
+			self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+		time.sleep(RESPONSE_DELAY)
+		with self.server.lock:
+			self.server.in_flight -= 1
+		self.send_response(200)
+		self.send_header("Content-Type", "application/sparql-results+json")
+		self.send_header("Content-Length", str(len(RESPONSE)))
+		self.end_headers()
+		self.wfile.write(RESPONSE)
+
+	def log_message(self, *args) -> None:
+		pass
+
+
+@pytest.fixture
+def endpoint() -> Iterator[StandInEndpoint]:
+	server = StandInEndpoint()
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	yield server
+	async_sparql.close_shared_client()
+	server.shutdown()
+	server.server_close()
+
+
+def test_concurrency_is_capped(endpoint: StandInEndpoint) -> None:
+	results = run_sparql_select_queries_concurrently([f"SELECT {n}" for n in range(12)], max_concurrency=3, endpoint=endpoint.url)
+
+	assert results == [{"s": ["http://x/s"], "o": ["o"]}] * 12
+	assert endpoint.max_in_flight == 3
+
+
+def test_request_starts_are_spaced(endpoint: StandInEndpoint) -> None:
+	min_interval = 0.05
+	run_sparql_select_queries_concurrently([f"SELECT {n}" for n in range(8)], max_concurrency=8, min_interval=min_interval, endpoint=endpoint.url)
+
+	assert len(endpoint.starts) == 8
+	# Compared with the first start, since opening a new connection delays the
+	# arrival of a single request, with a tolerance for that delay.
+	for n, start in enumerate(endpoint.starts):
+		assert start - endpoint.starts[0] >= n * min_interval - 0.03
+
+
+def test_connections_are_reused_across_calls(endpoint: StandInEndpoint) -> None:
+	for batch in range(3):
+		run_sparql_select_queries_concurrently([f"SELECT {batch} {n}" for n in range(4)], max_concurrency=2, endpoint=endpoint.url)
+
+	assert len(endpoint.starts) == 12
+	assert len(endpoint.client_ports) <= 2
@@ -1,23 +1,245 @@
 #!/usr/bin/python3
 
 import sys
+import os
 import json
+import pickle
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+from typing import Any, Optional
 import jsonschema
+from wdcgg_json import to_json_value
+
+SCHEMA_DIR = Path(__file__).parent / "json_schemas"
+DEFAULT_SCHEMA_CACHE_DIR = Path.home() / ".cache" / "icos_to_wdcgg" / "json_schemas"
+METADATA_FILE = "wdcgg_metadata.json"
+CONTACTS_FILE = "wdcgg_contacts.json"
+ORGANIZATIONS_FILE = "wdcgg_organizations.json"
+# Schema used for each file of a delivery. Files whose name ends with one of
+# these names (e.g. the corrected files produced by correct_metadata.py) are
+# validated against the same schema.
+DELIVERY_SCHEMAS = {
+	METADATA_FILE: "metadata.json_schema_202506.json",
+	CONTACTS_FILE: "contact.json_schema_202106.json",
+	ORGANIZATIONS_FILE: "organization.json_schema_202106.json"
+}
+# Field identifying the records of each kind of file in error reports.
+RECORD_ID_FIELDS = ("wc_wdcgg_catalogue_id", "ps_person_id", "or_organization_code")
+RECORDS_PER_TASK = 50
+
+
+@dataclass
+class RecordError:
+	file: str
+	record_index: Optional[int]
+	record_id: str
+	json_path: str
+	message: str
+
+	def __str__(self) -> str:
+		if self.record_index is not None: record = f"record {self.record_index}"
+		elif self.record_id != "": record = "record"
+		else: record = "file"
+		if self.record_id != "": record += f" ({self.record_id})"
+		return f"{self.file}: {record}, {self.json_path}: {self.message}"
+
+
+class InvalidRecordError(ValueError):
+	"""Raised when a record does not match the schema of the file it belongs to."""
+
+	def __init__(self, record: Any, errors: list[RecordError]):
+		super().__init__("\n".join(str(error) for error in errors))
+		self.record = record
+		self.errors = errors
+
+
+@cache
+def load_validator(schema_path: Path, cache_dir: Optional[Path] = DEFAULT_SCHEMA_CACHE_DIR) -> jsonschema.Draft7Validator:
+	"""Build the validator of a JSON schema, once per process.
+
+	The parsed schema is cached on disk, keyed by the hash of the schema file,
+	so that later runs skip parsing it. The schema is not checked against the
+	draft 7 meta-schema: the WDCGG schemas use the draft 3 boolean `required`,
+	which draft 7 validators ignore.
+	"""
+
+	content = schema_path.read_bytes()
+	cache_path = None if cache_dir is None else cache_dir / f"{hashlib.sha256(content).hexdigest()}.pickle"
+	if cache_path is not None and cache_path.exists():
+		try:
+			with open(cache_path, "rb") as file:
+				return jsonschema.Draft7Validator(pickle.load(file))
+		except (OSError, pickle.UnpicklingError, EOFError):
+			pass
+	schema = json.loads(content)
+	if cache_path is not None:
+		try:
+			cache_dir.mkdir(parents=True, exist_ok=True)
+			tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.part")
+			with open(tmp_path, "wb") as file:
+				pickle.dump(schema, file, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(tmp_path, cache_path)
+		except OSError:
+			pass
+	return jsonschema.Draft7Validator(schema)
+
+
+class RecordValidator:
+	"""Validator of single records of the files of a delivery, used to check
+	records as soon as they are produced.
+
+	Parameters
+	----------
+	schema_dir : Path
+		Directory of the JSON schemas.
+	cache_dir : Path, optional
+		Directory where parsed schemas are cached (see load_validator).
+	"""
+
+	def __init__(self, schema_dir: Path = SCHEMA_DIR, cache_dir: Optional[Path] = DEFAULT_SCHEMA_CACHE_DIR):
+		self._validators = {
+			file_name: load_validator(schema_dir / schema_file, cache_dir)
+			for file_name, schema_file in DELIVERY_SCHEMAS.items()
+		}
+
+	def errors(self, file_name: str, record: Any) -> list[RecordError]:
+		"""Return all schema violations of a record of one of the delivery files.
+
+		The record can be a dataclass record or its dictionary form.
+		"""
+
+		return record_errors(self._validators[file_name], file_name, None, to_json_value(record))
 
-if __name__ == "__main__":
-	json_schema_file = sys.argv[1]
-	json_file = sys.argv[2]
 
-	with open(json_schema_file, "r") as json_schema_f:
-		json_schema = json.loads(json_schema_f.read())
+def record_errors(validator: jsonschema.Draft7Validator, file_name: str, index: Optional[int], record: Any) -> list[RecordError]:
+	"""Validate a record of an array as a single-item array, so that array-level
+	keywords apply to the record the same way as to the whole file."""
 
-	validator = jsonschema.Draft7Validator(json_schema)
+	errors: list[RecordError] = []
+	for error in sorted(validator.iter_errors([record]), key=lambda error: list(map(str, error.absolute_path))):
+		path = list(error.absolute_path)[1:]
+		errors.append(RecordError(
+			file=file_name,
+			record_index=index,
+			record_id=record_id(record),
+			json_path=format_json_path(path if index is None else [index] + path),
+			message=error.message
+		))
+	return errors
+
+
+def record_id(record: Any) -> str:
+	if isinstance(record, dict):
+		for field in RECORD_ID_FIELDS:
+			if field in record: return str(record[field])
+	return ""
+
+
+def format_json_path(path: Any) -> str:
+	return "$" + "".join(f"[{part}]" if isinstance(part, int) else f".{part}" for part in path)
+
+
+def validate_records(schema_path: Path, file_name: str, first_index: int, records: list[Any]) -> list[RecordError]:
+	"""Validate records of an array against the schema of the array.
+
+	Every error is reported, not only the first one.
+	"""
+
+	validator = load_validator(schema_path)
+	errors: list[RecordError] = []
+	for n, record in enumerate(records):
+		errors.extend(record_errors(validator, file_name, first_index + n, record))
+	return errors
+
+
+def validate_file(schema_path: Path, json_file: Path, executor: Optional[ProcessPoolExecutor] = None) -> list[RecordError]:
+	"""Validate a JSON file against a JSON schema and report all errors.
+
+	If the file is an array, its records are validated by chunks, in parallel
+	if an executor is given, and array-level constraints are checked once on
+	the whole array.
+	"""
 
 	with open(json_file, "r") as json_f:
-		json_content = json.loads(json_f.read())
+		content = json.load(json_f)
+	validator = load_validator(schema_path)
+	if not isinstance(content, list) or "items" not in validator.schema:
+		return [
+			RecordError(json_file.name, None, "", format_json_path(error.absolute_path), error.message)
+			for error in validator.iter_errors(content)
+		]
+	array_validator = jsonschema.Draft7Validator({key: value for key, value in validator.schema.items() if key != "items"})
+	errors = [
+		RecordError(json_file.name, None, "", format_json_path(error.absolute_path), error.message)
+		for error in array_validator.iter_errors(content)
+	]
+	chunks = [
+		(schema_path, json_file.name, n, content[n:n + RECORDS_PER_TASK])
+		for n in range(0, len(content), RECORDS_PER_TASK)
+	]
+	if executor is None:
+		results = [validate_records(*chunk) for chunk in chunks]
+	else:
+		results = list(executor.map(validate_records, *zip(*chunks))) if chunks else []
+	for chunk_errors in results:
+		errors.extend(chunk_errors)
+	return errors
+
+
+def delivery_files(delivery_dir: Path, schema_dir: Path = SCHEMA_DIR) -> list[tuple[Path, Path]]:
+	"""List the files of a delivery directory with the schema of each one."""
+
+	files: list[tuple[Path, Path]] = []
+	for json_file in sorted(delivery_dir.glob("*.json")):
+		for suffix, schema_file in DELIVERY_SCHEMAS.items():
+			if json_file.name.endswith(suffix):
+				files.append((json_file, schema_dir / schema_file))
+	return files
+
 
-	validator.validate(json_content)
+def validate_delivery(delivery_dir: Path, workers: int = 1, schema_dir: Path = SCHEMA_DIR) -> list[RecordError]:
+	files = delivery_files(delivery_dir, schema_dir)
+	if len(files) == 0:
+		raise FileNotFoundError(f"No file to validate was found in {delivery_dir}.")
+	errors: list[RecordError] = []
+	with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+		for json_file, schema_path in files:
+			file_errors = validate_file(schema_path, json_file, executor)
+			print(f"{json_file.name}: {len(file_errors)} errors (schema {schema_path.name}).")
+			errors.extend(file_errors)
+	return errors
 
-	# If the validation fails, a ValidationError is raised. Therefore,
-	# the next message is only printed if the validation is successful.
-	print("Validation was successful.")
\ No newline at end of file
+
+def parse_arguments(argv: list[str]) -> argparse.Namespace:
+	parser = argparse.ArgumentParser(description="Validate WDCGG metadata files against their JSON schemas.")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+	file_parser = subparsers.add_parser("file", help="Validate one file against one schema.")
+	file_parser.add_argument("json_schema_file", type=Path)
+	file_parser.add_argument("json_file", type=Path)
+	delivery_parser = subparsers.add_parser("delivery", help="Validate all metadata files of a delivery directory.")
+	delivery_parser.add_argument("delivery_directory", type=Path)
+	delivery_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of processes validating records in parallel.")
+	delivery_parser.add_argument("--schema-dir", type=Path, default=SCHEMA_DIR, help="Directory of the JSON schemas.")
+	# Former usage: validate_json.py {schema_file} {json_file}
+	if len(argv) > 0 and argv[0] not in ("file", "delivery", "-h", "--help"):
+		argv = ["file"] + argv
+	return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+	args = parse_arguments(sys.argv[1:])
+	if args.command == "file":
+		errors = validate_file(args.json_schema_file, args.json_file)
+	else:
+		errors = validate_delivery(args.delivery_directory, args.workers, args.schema_dir)
+	for error in errors:
+		print(error)
+	if len(errors) > 0:
+		print(f"Validation failed with {len(errors)} errors.")
+		sys.exit(1)
+	print("Validation was successful.")
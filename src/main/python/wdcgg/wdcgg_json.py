@@ -0,0 +1,88 @@
+import json
+import os
+from dataclasses import fields, is_dataclass
+from functools import cache
+from pathlib import Path
+from typing import Any, Iterable
+
+
+@cache
+def field_names(cls: type) -> tuple[str, ...]:
+	return tuple(field.name for field in fields(cls))
+
+
+class WdcggJSONEncoder(json.JSONEncoder):
+	"""JSON encoder serializing dataclass records field by field.
+
+	Unlike dataclasses.asdict, which deep-copies every nested record before
+	serialization, each record is only turned into a shallow dictionary while
+	it is being encoded. Tuples are encoded as JSON arrays.
+	"""
+
+	def default(self, obj: Any) -> Any:
+		if is_dataclass(obj) and not isinstance(obj, type):
+			return {name: getattr(obj, name) for name in field_names(type(obj))}
+		return super().default(obj)
+
+
+def to_json_value(obj: Any) -> Any:
+	"""Turn records into the dictionaries and lists they are serialized to,
+	e.g. to validate them against a JSON schema."""
+
+	if is_dataclass(obj) and not isinstance(obj, type):
+		return {name: to_json_value(getattr(obj, name)) for name in field_names(type(obj))}
+	if isinstance(obj, (list, tuple)):
+		return [to_json_value(item) for item in obj]
+	if isinstance(obj, dict):
+		return {key: to_json_value(value) for key, value in obj.items()}
+	return obj
+
+
+class JsonArrayWriter:
+	"""Write a JSON array to a file one item at a time.
+
+	Items are appended to a temporary file next to the target file as soon as
+	they are written, so that the output of an unfinished run can be
+	inspected. finalize() closes the array and atomically renames the
+	temporary file to the target file. The result is identical to
+	serializing the whole list with json.dumps.
+	"""
+
+	def __init__(self, path: Path):
+		self.path = path
+		self.tmp_path = path.with_name(path.name + ".part")
+		self.count = 0
+		self._file = open(self.tmp_path, "w")
+		self._file.write("[")
+		self._encoder = WdcggJSONEncoder()
+
+	def __enter__(self) -> "JsonArrayWriter":
+		return self
+
+	def __exit__(self, exc_type: Any, *exc_info: Any) -> None:
+		if exc_type is None:
+			self.finalize()
+		else:
+			self._file.close()
+
+	def write(self, item: Any) -> None:
+		if self.count > 0:
+			self._file.write(", ")
+		self._file.write(self._encoder.encode(item))
+		self._file.flush()
+		self.count += 1
+
+	def finalize(self) -> None:
+		if self._file.closed:
+			return
+		self._file.write("]")
+		self._file.flush()
+		os.fsync(self._file.fileno())
+		self._file.close()
+		os.replace(self.tmp_path, self.path)
+
+
+def write_json_array(items: Iterable[Any], path: Path) -> None:
+	with JsonArrayWriter(path) as writer:
+		for item in items:
+			writer.write(item)
@@ -1,19 +1,22 @@
 from datetime import datetime
 import warnings
-from typing import Optional, Tuple, Any
-from dataclasses import dataclass, asdict
+from itertools import islice
+from typing import Optional, Tuple, Any, Iterable, Iterator, Sequence, Callable
+from dataclasses import dataclass
 from icoscp_core.icos import meta
-from icoscp_core.metacore import StationTimeSeriesMeta, Station, Person
+from icoscp_core.metacore import StationTimeSeriesMeta, Station, Person, References, parse_cp_json
 import sparql
-from obspack_netcdf import ObspackNetcdf, InstrumentDeployment
+import async_sparql
+from obspack_netcdf import InstrumentDeployment
+from validate_json import RecordValidator, RecordError, InvalidRecordError, METADATA_FILE, CONTACTS_FILE, ORGANIZATIONS_FILE
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class CalibrationScale:
 	name: str
 	wdcgg_code: str
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class InstrumentMethod:
 	method: str
 	code: str
@@ -47,10 +50,13 @@ WDCGG_SAMPLING_TYPES = {
 	"bag": "06", "PFP": "07", "remote": "08"
 }
 MAX_INSTRUMENTS = 5
+ROLES_QUERY_BATCH_SIZE = 100
+INSTRUMENTS_QUERY_BATCH_SIZE = 100
+PID_PREFIX = "11676/"
 OBJECT_SPECS_OBSPACK_RELEASE = {"CO2": "icosObspackCo2", "CH4": "icosObspackCh4", "N2O": "icosObspackN2o", "CO": "icosObspackCo"}
 
 
-@dataclass
+@dataclass(slots=True)
 class DobjInfo:
 	url: str
 	file_name: str
@@ -61,14 +67,14 @@ class DobjInfo:
 	authors: list[Person]
 	gas_species: str
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ScaleHistoryItem:
 	sh_start_date_time: str
 	sh_end_date_time: str
 	sc_scale_code: str
 	sc_scale: str
 
-@dataclass
+@dataclass(slots=True)
 class InstrumentDeploymentWdcgg:
 	ih_start_date_time: str
 	ih_end_date_time: str
@@ -76,13 +82,13 @@ class InstrumentDeploymentWdcgg:
 	mm_measurement_method_code: str
 	mm_measurement_method: str
 
-@dataclass
+@dataclass(slots=True)
 class SamplingHeightHistoryItem:
 	sh_start_date_time: str
 	sh_end_date_time: str
 	sh_sampling_height: str
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ValueUncertaintyHistory:
 	vh_start_datetime_1: str
 	vh_end_datetime_1: str
@@ -97,42 +103,42 @@ class ValueUncertaintyHistory:
 	vm_value_unc_method_code_3: str
 	vm_value_unc_method_3: str
 
-@dataclass
+@dataclass(slots=True)
 class OrganizationId:
 	or_organization_code: str
 
-@dataclass
+@dataclass(slots=True)
 class JointPerson:
 	or_organization_code: str
 	ps_person_id: str
 
-@dataclass
+@dataclass(slots=True)
 class ContactPersonId:
 	ps_person_id: str
 
-@dataclass
+@dataclass(slots=True)
 class ContactPersonDetails:
 	organization: str
 	role: str
 	role_code: str
 	country: str
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class DataFlagItem:
 	df_data_flag_code: str
 	df_data_flag: str
 	dg_data_flag: str
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Reference:
 	rg_reference: str
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class DoiInfo:
 	doi: str
 	doi_category_code: str
 
-@dataclass
+@dataclass(slots=True)
 class WdcggOrganization:
 	"""
 	Parameters
@@ -155,7 +161,7 @@ class WdcggOrganization:
 	or_address_3: str
 	or_website: str
 
-@dataclass
+@dataclass(slots=True)
 class ContactPerson:
 	"""
 	Parameters
@@ -188,7 +194,7 @@ class ContactPerson:
 	ps_phone: str
 	ps_fax: str
 
-@dataclass
+@dataclass(slots=True)
 class WdcggMetadata:
 	"""
 	Parameters
@@ -238,7 +244,7 @@ class WdcggMetadata:
 	md_editor_name: str
 	md_editor_email: str
 	Option: str
-	Update: list[str]
+	Update: Sequence[str]
 	wc_wdcgg_catalogue_id: str
 	or_organization_code: str
 	or_organization: str
@@ -251,7 +257,7 @@ class WdcggMetadata:
 	tz_time_zone: str
 	un_unit_code: str
 	un_unit: str
-	sh_scale_history: list[ScaleHistoryItem]
+	sh_scale_history: Sequence[ScaleHistoryItem]
 	ih_instrument_history: list[InstrumentDeploymentWdcgg]
 	sh_sampling_height_history: list[SamplingHeightHistoryItem]
 	sf_sampling_frequency_code: str
@@ -262,8 +268,8 @@ class WdcggMetadata:
 	md_da_mean_processing: str
 	md_mo_mean_processing: str
 	md_original_data_flag: str
-	dg_data_flag_group: list[DataFlagItem]
-	rg_reference_group: list[Reference]
+	dg_data_flag_group: Sequence[DataFlagItem]
+	rg_reference_group: Sequence[Reference]
 	st_status_code: str
 	st_status: str
 	dc_doi_category_code: str
@@ -271,62 +277,152 @@ class WdcggMetadata:
 	md_description: str
 	ri_reporting_interval_code: str
 	ri_reporting_interval: str
-	vh_value_unc_history: list[ValueUncertaintyHistory]
+	vh_value_unc_history: Sequence[ValueUncertaintyHistory]
+
+
+# Constant parts of the dataset metadata, shared by the records of all data objects.
+UPDATED_ITEMS = (
+	"or_organization",
+	"jl_joint_laboratory",
+	"pg_person_group",
+	"ao_aim_of_observation",
+	"tz_time_zone",
+	"un_unit",
+	"sh_scale_history",
+	"ih_instrument_history",
+	"sh_sampling_height_history",
+	"sf_sampling_frequency",
+	"md_measurement_calibration",
+	"md_data_processing",
+	"md_hr_mean_processing",
+	"md_da_mean_processing",
+	"md_mo_mean_processing",
+	"md_original_data_flag",
+	"dg_data_flag_group",
+	"rg_reference_group",
+	"st_status",
+	"dc_doi_category",
+	"md_description",
+	"ri_reporting_interval",
+	"vh_value_unc_history"
+)
+MEASUREMENT_CALIBRATION = "Measurement calibration at ICOS ATC is described in [Hazan et al., 2016], doi:10.5194/amt-9-4719-2016"
+DATA_PROCESSING = "Data processing at ICOS ATC is described in [Hazan et al., 2016], doi:10.5194/amt-9-4719-2016"
+HR_MEAN_PROCESSING = "Time-averaged values are reported at the middle time of the averaging interval. The document 'ICOS Atmospheric Station specifications' (doi:10.18160/GK28-2188) provides more detailed explanations about the sampling frequency."
+ORIGINAL_DATA_FLAG = ("- Flag 'U' = data correct before manual quality control\n"
+	"- Flag 'N' = data incorrect before manual quality control\n"
+	"- Flag 'O' = data correct after manual quality control\n"
+	"- Flag 'K' = data incorrect after manual quality control\n"
+	"- Flag 'R' = data correct after manual quality control and backward propagation of manual quality control from hourly data to minutely and raw data\n"
+	"- Flag 'H' = data incorrect after manual quality control and backward propagation of manual quality control from hourly data to minutely and raw data")
+DATA_FLAG_GROUP = (
+	DataFlagItem(df_data_flag_code="1", df_data_flag="Valid (background)", dg_data_flag="U"),
+	DataFlagItem(df_data_flag_code="1", df_data_flag="Valid (background)", dg_data_flag="O"),
+	DataFlagItem(df_data_flag_code="1", df_data_flag="Valid (background)", dg_data_flag="R"),
+	DataFlagItem(df_data_flag_code="3", df_data_flag="Invalid", dg_data_flag="N"),
+	DataFlagItem(df_data_flag_code="3", df_data_flag="Invalid", dg_data_flag="K"),
+	DataFlagItem(df_data_flag_code="3", df_data_flag="Invalid", dg_data_flag="H")
+)
+REFERENCE_GROUP = (
+	Reference(rg_reference="Hazan, L., Tarniewicz, J., Ramonet, M., Laurent, O., and Abbaris, A.: Automatic processing of atmospheric CO2 and CH4 mole fractions at the ICOS Atmosphere Thematic Centre, Atmos. Meas. Tech., 9, 4719-4736, doi:10.5194/amt-9-4719-2016, 2016."),
+	Reference(rg_reference="Yver Kwok, C., Laurent, O., Guemri, A., Philippon, C., Wastine, B., Rella, C. W., Vuillemin, C., Truong, F., Delmotte, M., Kazan, V., Darding, M., Lebègue, B., Kaiser, C., Xueref-Rémy, I., and Ramonet, M.: Comprehensive laboratory and field testing of cavity ring-down spectroscopy analyzers measuring H2O, CO2, CH4 and CO, Atmos. Meas. Tech., 8, 3867–3892, https://doi.org/10.5194/amt-8-3867-2015, 2015."),
+	Reference(rg_reference="Yver-Kwok, C., Philippon, C., Bergamaschi, P., Biermann, T., Calzolari, F., Chen, H., Conil, S., Cristofanelli, P., Delmotte, M., Hatakka, J., Heliasz, M., Hermansen, O., Komínková, K., Kubistin, D., Kumps, N., Laurent, O., Laurila, T., Lehner, I., Levula, J., Lindauer, M., Lopez, M., Mammarella, I., Manca, G., Marklund, P., Metzger, J.-M., Mölder, M., Platt, S. M., Ramonet, M., Rivier, L., Scheeren, B., Sha, M. K., Smith, P., Steinbacher, M., Vítková, G., and Wyss, S.: Evaluation and optimization of ICOS atmosphere station data as part of the labeling process, Atmos. Meas. Tech., 14, 89–116, https://doi.org/10.5194/amt-14-89-2021, 2021.")
+)
+DATA_POLICY = ("DATA POLICY:\n"
+	"ICOS data is licensed under a Creative Commons Attribution 4.0 international licence (https://creativecommons.org/licenses/by/4.0/). ICOS data licence is described at https://data.icos-cp.eu/licence.")
+VALUE_UNC_HISTORY = (ValueUncertaintyHistory(
+	vh_start_datetime_1="9999-12-31T00:00:00",
+	vh_end_datetime_1="9999-12-31T23:59:59",
+	vm_value_unc_method_code_1="10",
+	vm_value_unc_method_1="short term repeatability",
+	vh_start_datetime_2="9999-12-31T00:00:00",
+	vh_end_datetime_2="9999-12-31T23:59:59",
+	vm_value_unc_method_code_2="10",
+	vm_value_unc_method_2="short term repeatability",
+	vh_start_datetime_3="9999-12-31T00:00:00",
+	vh_end_datetime_3="9999-12-31T23:59:59",
+	vm_value_unc_method_code_3="10",
+	vm_value_unc_method_3="short term repeatability"
+),)
+SCALE_HISTORIES = {
+	gas_species: (ScaleHistoryItem(
+		sh_start_date_time="9999-12-31T00:00:00",
+		sh_end_date_time="9999-12-31T23:59:59",
+		sc_scale_code=scale.wdcgg_code,
+		sc_scale=scale.name
+	),)
+	for gas_species, scale in SCALES.items()
+}
 
 
 class WdcggMetadataClient:
-	def __init__(self, submission_window: sparql.SubmissionWindow):
+	"""Producer of the WDCGG metadata records of data objects.
+
+	Contact persons and organizations are numbered in the order in which they
+	are first met, and kept until the end of the run. Dataset metadata records
+	are kept in the metadata list, unless a metadata sink is given, in which
+	case each record is passed to the sink as soon as it is produced.
+
+	If a record validator is given, every record is validated as soon as it is
+	created. Invalid contacts and organizations are left out of valid_contacts
+	and valid_organizations, and dobj_metadata raises an InvalidRecordError,
+	without storing the record, if the dataset metadata record or one of the
+	contacts it refers to is invalid.
+	"""
+
+	def __init__(
+			self,
+			submission_window: sparql.SubmissionWindow,
+			concurrent_queries: int = 1,
+			metadata_sink: Optional[Callable[[Any], None]] = None,
+			validator: Optional[RecordValidator] = None,
+			query_interval: float = 0.0):
 		self.submission_window = submission_window
-		self.metadata: list[dict[str, Any]] = []
-		self.contacts: list[dict[str, Any]] = []
+		self.concurrent_queries = concurrent_queries
+		# Minimum time in seconds between the starts of two concurrent queries.
+		self.query_interval = query_interval
+		self.metadata_sink = metadata_sink
+		self.validator = validator
+		# Records produced by this client, and dictionaries restored from a run manifest.
+		self.metadata: list[WdcggMetadata | dict[str, Any]] = []
+		self.contacts: list[ContactPerson | dict[str, Any]] = []
 		self.contact_ids: dict[str, str] = {}
-		self.organizations: list[dict[str, Any]] = []
+		self.organizations: list[WdcggOrganization | dict[str, Any]] = []
 		self.organization_ids: dict[str, str] = {}
-		self.instruments: dict[int, str] = {}
-
-	def dobj_metadata(self, dobj_info: DobjInfo, netcdf_data: ObspackNetcdf, wdcgg_station_id: str) -> None:
+		# Schema violations of the invalid contacts (including those of their
+		# organization) and organizations, by contact ID and organization code.
+		self.contact_errors: dict[str, list[RecordError]] = {}
+		self.organization_errors: dict[str, list[RecordError]] = {}
+		self.instruments: dict[int, Optional[str]] = {}
+		self.contributor_roles: dict[Tuple[str, str], list[str]] = {}
+		self.obspack_releases: dict[str, DoiInfo] = {}
+
+	def dobj_metadata(self, dobj_info: DobjInfo, instr_hist: list[InstrumentDeployment], wdcgg_station_id: str) -> WdcggMetadata:
 		"""Structure metadata according to WDCGG template for dataset metadata.
 
 		Returns
 		-------
-		WdcggMetadata object containing metadata about the data object
-		according to the WDCGG JSON template.
+		Record containing metadata about the data object according to the
+		WDCGG JSON template, which is also appended to the metadata list
+		or passed to the metadata sink.
+		Its constant parts are shared with the other records; it is serialized
+		with wdcgg_json.WdcggJSONEncoder.
+
+		Raises
+		------
+		InvalidRecordError
+			If the client validates records and the record is invalid.
 		"""
 
-		scale = SCALES[dobj_info.gas_species]
 		doi_info = self.doi_obspack_release(OBJECT_SPECS_OBSPACK_RELEASE[dobj_info.gas_species])
 
-		self.metadata.append(asdict(WdcggMetadata(
+		record = WdcggMetadata(
 			Contributor = CONTRIBUTOR,
 			Submission_date = "2024-08-01 12:00:00",
 			md_editor_name = "Jonathan Schenk",
 			md_editor_email = "jonathan.schenk@nateko.lu.se",
 			Option = "1",
-			Update = [
-				"or_organization",
-				"jl_joint_laboratory",
-				"pg_person_group",
-				"ao_aim_of_observation",
-				"tz_time_zone",
-				"un_unit",
-				"sh_scale_history",
-				"ih_instrument_history",
-				"sh_sampling_height_history",
-				"sf_sampling_frequency",
-				"md_measurement_calibration",
-				"md_data_processing",
-				"md_hr_mean_processing",
-				"md_da_mean_processing",
-				"md_mo_mean_processing",
-				"md_original_data_flag",
-				"dg_data_flag_group",
-				"rg_reference_group",
-				"st_status",
-				"dc_doi_category",
-				"md_description",
-				"ri_reporting_interval",
-				"vh_value_unc_history"
-			],
+			Update = UPDATED_ITEMS,
 			wc_wdcgg_catalogue_id = self.wdcgg_catalog_id(dobj_info.url, wdcgg_station_id, dobj_info.file_name, dobj_info.gas_species),
 			or_organization_code = CONTRIBUTOR,
 			or_organization = "ICOS",
@@ -339,13 +435,8 @@ class WdcggMetadataClient:
 			tz_time_zone = "UTC",
 			un_unit_code = "1" if dobj_info.gas_species == "CO2" else "2",
 			un_unit = "ppm" if dobj_info.gas_species == "CO2" else "ppb",
-			sh_scale_history = [ScaleHistoryItem(
-				sh_start_date_time="9999-12-31T00:00:00",
-				sh_end_date_time="9999-12-31T23:59:59",
-				sc_scale_code=scale.wdcgg_code,
-				sc_scale=scale.name
-			)],
-			ih_instrument_history = self.instrument_history(dobj_info.url, netcdf_data),
+			sh_scale_history = SCALE_HISTORIES[dobj_info.gas_species],
+			ih_instrument_history = self.instrument_history(instr_hist),
 			sh_sampling_height_history = [SamplingHeightHistoryItem(
 				sh_start_date_time="9999-12-31T00:00:00",
 				sh_end_date_time="9999-12-31T23:59:59",
@@ -353,30 +444,14 @@ class WdcggMetadataClient:
 			)],
 			sf_sampling_frequency_code = "88",
 			sf_sampling_frequency = "",
-			md_measurement_calibration = "Measurement calibration at ICOS ATC is described in [Hazan et al., 2016], doi:10.5194/amt-9-4719-2016",
-			md_data_processing = "Data processing at ICOS ATC is described in [Hazan et al., 2016], doi:10.5194/amt-9-4719-2016",
-			md_hr_mean_processing = "Time-averaged values are reported at the middle time of the averaging interval. The document 'ICOS Atmospheric Station specifications' (doi:10.18160/GK28-2188) provides more detailed explanations about the sampling frequency.",
+			md_measurement_calibration = MEASUREMENT_CALIBRATION,
+			md_data_processing = DATA_PROCESSING,
+			md_hr_mean_processing = HR_MEAN_PROCESSING,
 			md_da_mean_processing = "",
 			md_mo_mean_processing = "",
-			md_original_data_flag = ("- Flag 'U' = data correct before manual quality control\n"
-				"- Flag 'N' = data incorrect before manual quality control\n"
-				"- Flag 'O' = data correct after manual quality control\n"
-				"- Flag 'K' = data incorrect after manual quality control\n"
-				"- Flag 'R' = data correct after manual quality control and backward propagation of manual quality control from hourly data to minutely and raw data\n"
-				"- Flag 'H' = data incorrect after manual quality control and backward propagation of manual quality control from hourly data to minutely and raw data"),
-			dg_data_flag_group = [
-				DataFlagItem(df_data_flag_code="1", df_data_flag="Valid (background)", dg_data_flag="U"),
-				DataFlagItem(df_data_flag_code="1", df_data_flag="Valid (background)", dg_data_flag="O"),
-				DataFlagItem(df_data_flag_code="1", df_data_flag="Valid (background)", dg_data_flag="R"),
-				DataFlagItem(df_data_flag_code="3", df_data_flag="Invalid", dg_data_flag="N"),
-				DataFlagItem(df_data_flag_code="3", df_data_flag="Invalid", dg_data_flag="K"),
-				DataFlagItem(df_data_flag_code="3", df_data_flag="Invalid", dg_data_flag="H"),
-			],
-			rg_reference_group = [
-				Reference(rg_reference="Hazan, L., Tarniewicz, J., Ramonet, M., Laurent, O., and Abbaris, A.: Automatic processing of atmospheric CO2 and CH4 mole fractions at the ICOS Atmosphere Thematic Centre, Atmos. Meas. Tech., 9, 4719-4736, doi:10.5194/amt-9-4719-2016, 2016."),
-				Reference(rg_reference="Yver Kwok, C., Laurent, O., Guemri, A., Philippon, C., Wastine, B., Rella, C. W., Vuillemin, C., Truong, F., Delmotte, M., Kazan, V., Darding, M., Lebègue, B., Kaiser, C., Xueref-Rémy, I., and Ramonet, M.: Comprehensive laboratory and field testing of cavity ring-down spectroscopy analyzers measuring H2O, CO2, CH4 and CO, Atmos. Meas. Tech., 8, 3867–3892, https://doi.org/10.5194/amt-8-3867-2015, 2015."),
-				Reference(rg_reference="Yver-Kwok, C., Philippon, C., Bergamaschi, P., Biermann, T., Calzolari, F., Chen, H., Conil, S., Cristofanelli, P., Delmotte, M., Hatakka, J., Heliasz, M., Hermansen, O., Komínková, K., Kubistin, D., Kumps, N., Laurent, O., Laurila, T., Lehner, I., Levula, J., Lindauer, M., Lopez, M., Mammarella, I., Manca, G., Marklund, P., Metzger, J.-M., Mölder, M., Platt, S. M., Ramonet, M., Rivier, L., Scheeren, B., Sha, M. K., Smith, P., Steinbacher, M., Vítková, G., and Wyss, S.: Evaluation and optimization of ICOS atmosphere station data as part of the labeling process, Atmos. Meas. Tech., 14, 89–116, https://doi.org/10.5194/amt-14-89-2021, 2021.")
-			],
+			md_original_data_flag = ORIGINAL_DATA_FLAG,
+			dg_data_flag_group = DATA_FLAG_GROUP,
+			rg_reference_group = REFERENCE_GROUP,
 			st_status_code = "1",
 			st_status = "Operational/Reporting",
 			dc_doi_category_code = doi_info.doi_category_code,
@@ -386,25 +461,75 @@ class WdcggMetadataClient:
 				f"PID: {dobj_info.pid}\n\n"
 				"Citation:\n"
 				f"{dobj_info.citation_string}\n\n"
-				"DATA POLICY:\n"
-				"ICOS data is licensed under a Creative Commons Attribution 4.0 international licence (https://creativecommons.org/licenses/by/4.0/). ICOS data licence is described at https://data.icos-cp.eu/licence."),
+				f"{DATA_POLICY}"),
 			ri_reporting_interval_code = "3001",
 			ri_reporting_interval = "1 hour",
-			vh_value_unc_history = [ValueUncertaintyHistory(
-				vh_start_datetime_1="9999-12-31T00:00:00",
-				vh_end_datetime_1="9999-12-31T23:59:59",
-				vm_value_unc_method_code_1="10",
-				vm_value_unc_method_1="short term repeatability",
-				vh_start_datetime_2="9999-12-31T00:00:00",
-				vh_end_datetime_2="9999-12-31T23:59:59",
-				vm_value_unc_method_code_2="10",
-				vm_value_unc_method_2="short term repeatability",
-				vh_start_datetime_3="9999-12-31T00:00:00",
-				vh_end_datetime_3="9999-12-31T23:59:59",
-				vm_value_unc_method_code_3="10",
-				vm_value_unc_method_3="short term repeatability"
-			)]
-		)))
+			vh_value_unc_history = VALUE_UNC_HISTORY
+		)
+		if self.validator is not None:
+			errors = self.validator.errors(METADATA_FILE, record)
+			for contact in record.pg_person_group:
+				errors.extend(self.contact_errors.get(contact.ps_person_id, []))
+			if len(errors) > 0:
+				raise InvalidRecordError(record, errors)
+		self.store_metadata(record)
+		return record
+
+	def restore(
+			self,
+			metadata: dict[str, Any],
+			contacts: list[dict[str, Any]],
+			contact_ids: dict[str, str],
+			organizations: list[dict[str, Any]],
+			organization_ids: dict[str, str],
+			quarantined: bool = False) -> None:
+		"""Add the metadata produced for a data object by a previous run, as recorded in a run manifest.
+
+		The metadata record of a quarantined data object is not stored, but its
+		contacts and organizations are, so that IDs are assigned as in the
+		previous run.
+		"""
+
+		if not quarantined:
+			self.store_metadata(metadata)
+		for organization in organizations:
+			self.add_organization(organization)
+		self.organization_ids.update(organization_ids)
+		for contact in contacts:
+			self.add_contact(contact)
+		self.contact_ids.update(contact_ids)
+
+	def store_metadata(self, record: WdcggMetadata | dict[str, Any]) -> None:
+		if self.metadata_sink is None:
+			self.metadata.append(record)
+		else:
+			self.metadata_sink(record)
+
+	def add_contact(self, contact: ContactPerson | dict[str, Any]) -> None:
+		self.contacts.append(contact)
+		if self.validator is None:
+			return
+		errors = self.validator.errors(CONTACTS_FILE, contact)
+		errors.extend(self.organization_errors.get(record_field(contact, "or_organization_code"), []))
+		if len(errors) > 0:
+			self.contact_errors[record_field(contact, "ps_person_id")] = errors
+
+	def add_organization(self, organization: WdcggOrganization | dict[str, Any]) -> None:
+		self.organizations.append(organization)
+		if self.validator is None:
+			return
+		errors = self.validator.errors(ORGANIZATIONS_FILE, organization)
+		if len(errors) > 0:
+			self.organization_errors[record_field(organization, "or_organization_code")] = errors
+
+	def valid_contacts(self) -> list[ContactPerson | dict[str, Any]]:
+		return [contact for contact in self.contacts if record_field(contact, "ps_person_id") not in self.contact_errors]
+
+	def valid_organizations(self) -> list[WdcggOrganization | dict[str, Any]]:
+		return [
+			organization for organization in self.organizations
+			if record_field(organization, "or_organization_code") not in self.organization_errors
+		]
 
 	def get_contacts_metadata(self, authors: list[Person], station: Station) -> list[ContactPersonId]:
 		"""Gather metadata about contact persons.
@@ -425,7 +550,7 @@ class WdcggMetadataClient:
 			else:
 				person_id = f"NEW{len(self.contact_ids) + 1}"
 				self.contact_ids[uri] = person_id
-				self.contacts.append(asdict(ContactPerson(
+				self.add_contact(ContactPerson(
 					ps_person_id=person_id,
 					ps_name=" ".join([author.firstName, author.lastName]),
 					ps_email=author.email or "",
@@ -439,13 +564,52 @@ class WdcggMetadataClient:
 					ps_address_3="",
 					ps_phone="",
 					ps_fax=""
-				)))
+				))
 			contacts.append(ContactPersonId(ps_person_id=person_id))
 		return contacts
 
+	def prefetch_contributor_roles(self, dobj_infos: list[DobjInfo]) -> None:
+		"""Look up the roles of all authors of the data objects at their stations.
+
+		The (author, station) pairs are resolved in batches of VALUES-based SPARQL
+		queries and the roles are kept in an index consulted by get_person_details.
+		"""
+
+		pairs: list[Tuple[str, str]] = []
+		for dobj_info in dobj_infos:
+			for author in dobj_info.authors:
+				pair = (author.self.uri, dobj_info.station.org.self.uri)
+				if pair not in self.contributor_roles:
+					self.contributor_roles[pair] = []
+					pairs.append(pair)
+		queries = [
+			sparql.contributor_roles_bulk_query(pairs[n:n + ROLES_QUERY_BATCH_SIZE])
+			for n in range(0, len(pairs), ROLES_QUERY_BATCH_SIZE)
+		]
+		for results in self.run_batched_queries(queries, "contributor_roles"):
+			if not results: continue
+			for contributor, organization, role in zip(results["contributor"], results["organization"], results["role"]):
+				self.contributor_roles[(contributor, organization)].append(role)
+
+	def with_contributor_roles(self, dobj_infos: Iterable[DobjInfo], batch_size: int) -> Iterator[DobjInfo]:
+		"""Yield the data objects, looking up the roles of their authors with
+		prefetch_contributor_roles for `batch_size` data objects at a time (for
+		all of them at once if 0), so that a listing can be processed as it comes in.
+		"""
+
+		dobj_infos = iter(dobj_infos)
+		while len(batch := list(islice(dobj_infos, batch_size or None))) > 0:
+			self.prefetch_contributor_roles(batch)
+			yield from batch
+
 	def get_person_details(self, person_uri: str, station: Station) -> ContactPersonDetails:
-		query = sparql.contributor_roles_query(person_uri, station.org.self.uri)
-		results = sparql.run_sparql_select_query_single_param(query)
+		pair = (person_uri, station.org.self.uri)
+		if pair in self.contributor_roles:
+			results = self.contributor_roles[pair]
+		else:
+			query = sparql.contributor_roles_query(person_uri, station.org.self.uri)
+			results = sparql.run_sparql_select_query_single_param(query, kind="contributor_roles")
+			self.contributor_roles[pair] = results
 		if len(results) == 0:
 			warnings.warn(f"No role was found for {person_uri} at station {station.org.self.uri}.")
 			role = "Contact Person"
@@ -466,7 +630,7 @@ class WdcggMetadataClient:
 		else:
 			org_id = f"{len(self.organization_ids) + 1}"
 			self.organization_ids[org_label] = org_id
-			self.organizations.append(asdict(WdcggOrganization(
+			self.add_organization(WdcggOrganization(
 				or_organization_code=org_id,
 				or_acronym=org_label,
 				or_name=org.name,
@@ -475,7 +639,7 @@ class WdcggMetadataClient:
 				or_address_2="",
 				or_address_3="",
 				or_website=org.website or ""
-			)))
+			))
 
 		return ContactPersonDetails(role=role, role_code=role_code, organization=org_id, country=country)
 
@@ -526,7 +690,7 @@ class WdcggMetadataClient:
 			"9999"
 		])
 
-	def instrument_history(self, url: str, netcdf_data: ObspackNetcdf) -> list[InstrumentDeploymentWdcgg]:
+	def instrument_history(self, instr_hist: list[InstrumentDeployment]) -> list[InstrumentDeploymentWdcgg]:
 		"""Format the instrument history according to WDCGG requirements.
 
 		Returns
@@ -537,9 +701,9 @@ class WdcggMetadataClient:
 		changed more than a predefined number of times.
 		"""
 
-		instr_hist = netcdf_data.instrument_history("time", "instrument")
 		if len(instr_hist) == 0 or len(instr_hist) > MAX_INSTRUMENTS:
 			return []
+		self.fetch_instruments([int(deployment.atc_id) for deployment in instr_hist])
 		instr_hist_wdcgg: list[InstrumentDeploymentWdcgg] = []
 		for deployment in instr_hist:
 			instr_hist_wdcgg.append(self.instrument_deployment_to_wdcgg_format(deployment))
@@ -547,23 +711,68 @@ class WdcggMetadataClient:
 		instr_hist_wdcgg[-1].ih_end_date_time = "9999-12-31T23:59:59"
 		return instr_hist_wdcgg
 
+	def prefetch_instruments(self) -> None:
+		"""Fill the instrument cache with the labels of all ATC instruments in a single query."""
+
+		self.store_instrument_labels(self.run_batched_queries([sparql.atc_instruments_query()], "instrument"))
+
+	def fetch_instruments(self, atc_ids: list[int]) -> None:
+		"""Look up, in batches, the labels of the instruments missing from the cache.
+
+		Instruments that are not found are cached as None so that they are only queried once.
+		"""
+
+		missing = sorted(set(atc_id for atc_id in atc_ids if atc_id not in self.instruments))
+		for atc_id in missing:
+			self.instruments[atc_id] = None
+		queries = [
+			sparql.atc_instruments_query(missing[n:n + INSTRUMENTS_QUERY_BATCH_SIZE])
+			for n in range(0, len(missing), INSTRUMENTS_QUERY_BATCH_SIZE)
+		]
+		self.store_instrument_labels(self.run_batched_queries(queries, "instrument"))
+
+	def store_instrument_labels(self, batch_results: list[Optional[dict[str, list[Any]]]]) -> None:
+		for results in batch_results:
+			if not results: continue
+			for instrument_uri, instr_label in zip(results["instrument"], results["instrumentInfo"]):
+				# The portal only enforces the ATC_ prefix; instruments whose ID is
+				# not a number cannot be deployed in an Obspack file and are skipped.
+				try:
+					atc_id = int(instrument_uri.split("_")[-1])
+				except ValueError:
+					continue
+				self.instruments[atc_id] = instr_label
+
+	def run_batched_queries(self, queries: list[str], kind: str) -> list[Optional[dict[str, list[Any]]]]:
+		"""Run multi-parameter SPARQL queries, concurrently if the client allows it.
+
+		Returns
+		-------
+		The results of the queries, in the same order as the queries.
+		"""
+
+		if self.concurrent_queries > 1 and len(queries) > 1:
+			sparql_client = sparql.get_sparql_client()
+			return async_sparql.run_sparql_select_queries_concurrently(
+				queries, kind, self.concurrent_queries, self.query_interval,
+				cache=sparql_client.cache, retrier=sparql_client.retrier, endpoint=sparql_client.endpoint
+			)
+		return [sparql.run_sparql_select_query_multi_params(query, kind=kind) for query in queries]
+
 	def instrument_deployment_to_wdcgg_format(self, deployment: InstrumentDeployment) -> InstrumentDeploymentWdcgg:
-		if deployment.atc_id in self.instruments.keys():
-			instr_label = self.instruments[deployment.atc_id]
-		else:
-			instr_query = sparql.instrument_query(deployment.atc_id)
-			instr_label = sparql.run_sparql_select_query_single_param(instr_query)
-			if len(instr_label) == 0:
-				warnings.warn(f"Instrument ATC_{deployment.atc_id} was not found.")
-				return InstrumentDeploymentWdcgg(
-					ih_start_date_time=timestamp_to_str(deployment.time_period.start_time, "%Y-%m-%dT%H:%M:%S"),
-					ih_end_date_time=timestamp_to_str(deployment.time_period.end_time, "%Y-%m-%dT%H:%M:%S"),
-					ih_instrument="",
-					mm_measurement_method_code="",
-					mm_measurement_method=""
-				)
-			instr_label = instr_label[0]
-			self.instruments[deployment.atc_id] = instr_label
+		atc_id = int(deployment.atc_id)
+		if atc_id not in self.instruments:
+			self.fetch_instruments([atc_id])
+		instr_label = self.instruments[atc_id]
+		if instr_label is None:
+			warnings.warn(f"Instrument ATC_{atc_id} was not found.")
+			return InstrumentDeploymentWdcgg(
+				ih_start_date_time=timestamp_to_str(deployment.time_period.start_time, "%Y-%m-%dT%H:%M:%S"),
+				ih_end_date_time=timestamp_to_str(deployment.time_period.end_time, "%Y-%m-%dT%H:%M:%S"),
+				ih_instrument="",
+				mm_measurement_method_code="",
+				mm_measurement_method=""
+			)
 		wdcgg_method_code, wdcgg_method = self.get_wdcgg_instrument_method(instr_label)
 		return InstrumentDeploymentWdcgg(
 			ih_start_date_time=timestamp_to_str(deployment.time_period.start_time, "%Y-%m-%dT%H:%M:%S"),
@@ -580,24 +789,43 @@ class WdcggMetadataClient:
 		else:
 			return "", ""
 
-	def doi_obspack_release(self, object_spec: str) -> DoiInfo:
-		query = sparql.obspack_release_query(object_spec, self.submission_window)
-		dois = sparql.run_sparql_select_query_single_param(query)
+	def prefetch_obspack_releases(self, object_specs: Optional[list[str]] = None) -> None:
+		"""Resolve the DOIs of the Obspack releases of several object specifications
+		(by default, of all gas species) with a single SPARQL query."""
+
+		if object_specs is None:
+			object_specs = list(OBJECT_SPECS_OBSPACK_RELEASE.values())
+		query = sparql.obspack_releases_query(object_specs, self.submission_window)
+		results = sparql.run_sparql_select_query_multi_params(query, kind="obspack_release") or {}
+		dois: dict[str, list[str]] = {object_spec: [] for object_spec in object_specs}
+		for spec_uri, doi in zip(results.get("spec", []), results.get("doi", [])):
+			dois[str(spec_uri).removeprefix(sparql.OBJECT_SPEC_PREFIX)].append(str(doi))
 		earliest, latest = sparql.submission_window_to_utc_str(self.submission_window, "%Y-%m-%d")
-		if len(dois) > 1:
-			warnings.warn(
-				"More than one Obspack release was found in the time period "
-				f"{earliest} to {latest}. The latest was used."
-			)
-			return DoiInfo(doi=dois[0], doi_category_code="2")
-		elif len(dois) == 1:
-			return DoiInfo(doi=dois[0], doi_category_code="2")
-		else:
-			warnings.warn(
-				f"No Obspack release was found in the time period {earliest} to {latest}."
-			)
-			return DoiInfo(doi="", doi_category_code="9")
+		for object_spec, spec_dois in dois.items():
+			if len(spec_dois) > 1:
+				warnings.warn(
+					f"More than one Obspack release of {object_spec} was found in the time period "
+					f"{earliest} to {latest}. The latest was used."
+				)
+				self.obspack_releases[object_spec] = DoiInfo(doi=spec_dois[0], doi_category_code="2")
+			elif len(spec_dois) == 1:
+				self.obspack_releases[object_spec] = DoiInfo(doi=spec_dois[0], doi_category_code="2")
+			else:
+				warnings.warn(
+					f"No Obspack release of {object_spec} was found in the time period {earliest} to {latest}."
+				)
+				self.obspack_releases[object_spec] = DoiInfo(doi="", doi_category_code="9")
 
+	def doi_obspack_release(self, object_spec: str) -> DoiInfo:
+		"""Return the DOI of the latest Obspack release of the object specification,
+		which is resolved only once per client, along with the other species."""
+
+		if object_spec not in self.obspack_releases:
+			unresolved = [spec for spec in OBJECT_SPECS_OBSPACK_RELEASE.values() if spec not in self.obspack_releases]
+			if object_spec not in unresolved:
+				unresolved.append(object_spec)
+			self.prefetch_obspack_releases(unresolved)
+		return self.obspack_releases[object_spec]
 
 def get_dobj_info(dobj_url: str) -> Optional[DobjInfo]:
 	"""Extract relevant information from ICOS metadata.
@@ -641,18 +869,7 @@ def get_dobj_info(dobj_url: str) -> Optional[DobjInfo]:
 		else:
 			authors = [author for author in dobj_meta.references.authors if isinstance(author, Person)]
 		# Gas species
-		prefix_msg = f"The gas species covered by data object {dobj_url} cannot be determined"
-		keywords = dobj_meta.specification.keywords
-		if keywords is None:
-			raise ValueError(f"{prefix_msg} for lack of keyword.")
-		else:
-			dobj_gas_species = set(keywords).intersection(WDCGG_GAS_SPECIES_CODES.keys())
-			if len(dobj_gas_species) == 0:
-				raise ValueError(f"{prefix_msg} because none of 'CO2', 'CH4', 'N2O' and 'CO' appear in the keywords.")
-			elif len(dobj_gas_species) == 1:
-				gas_species = list(dobj_gas_species)[0]
-			else:
-				raise ValueError(f"{prefix_msg} because more than one gas species were found in the keywords.")
+		gas_species = gas_species_from_keywords(dobj_url, dobj_meta.specification.keywords)
 
 		return DobjInfo(
 			url=dobj_url,
@@ -672,5 +889,92 @@ def get_dobj_info(dobj_url: str) -> Optional[DobjInfo]:
 		return None
 
 
+def get_dobj_infos(submission_window: sparql.SubmissionWindow, page_size: int = sparql.DEFAULT_PAGE_SIZE, prefetch: int = 1) -> list[DobjInfo]:
+	"""Extract relevant information from ICOS metadata for all Obspack time series
+	submitted during the submission window.
+
+	Returns
+	-------
+	A list of DobjInfo objects, ordered by submission time.
+	"""
+
+	return list(iter_dobj_infos(submission_window, page_size, prefetch))
+
+
+def iter_dobj_infos(submission_window: sparql.SubmissionWindow, page_size: int = sparql.DEFAULT_PAGE_SIZE, prefetch: int = 1) -> Iterator[DobjInfo]:
+	"""Yield relevant information from ICOS metadata for all Obspack time series
+	submitted during the submission window, ordered by submission time.
+
+	Unlike get_dobj_info, which fetches the full metadata of one data object,
+	the information about all data objects is obtained with one SPARQL query,
+	whose results are streamed in pages of `page_size` rows (`prefetch` pages
+	being fetched concurrently), and the metadata of each station is only
+	fetched once. Data objects are yielded as soon as their page is in, so
+	they can be processed before the whole listing is fetched.
+	"""
+
+	query = sparql.obspack_dobj_info_query(submission_window)
+	stations: dict[str, Station] = {}
+	for row in sparql.iter_sparql_select_query_paged(query, page_size, prefetch, kind="dobj_list"):
+		dobj_url = row["dobj"]
+		station_uri = row["station"]
+		if station_uri not in stations:
+			stations[station_uri] = meta.get_station_meta(station_uri)
+		references = None if row["biblioInfo"] is None else parse_cp_json(row["biblioInfo"], References)
+		# Citation string
+		if references is None or references.citationString is None:
+			warnings.warn(f"No citation string provided for data object {dobj_url}.")
+			citation_string = ""
+		else:
+			citation_string = references.citationString
+		# Sampling height
+		if row["samplingHeight"] is None:
+			warnings.warn(f"No sampling height provided for data object {dobj_url}.")
+			sampling_height = ""
+		else:
+			sampling_height = str(float(row["samplingHeight"]))
+		# Authors
+		if references is None or references.authors is None:
+			warnings.warn(f"No individual author is listed for data object {dobj_url}.")
+			authors = []
+		else:
+			authors = [author for author in references.authors if isinstance(author, Person)]
+		# Gas species
+		keywords = None if row["keywords"] is None else [keyword.strip() for keyword in row["keywords"].split(",")]
+		gas_species = gas_species_from_keywords(dobj_url, keywords)
+
+		yield DobjInfo(
+			url=dobj_url,
+			file_name=row["fileName"],
+			pid=PID_PREFIX + dobj_url.split("/")[-1],
+			citation_string=citation_string,
+			station=stations[station_uri],
+			sampling_height=sampling_height,
+			authors=authors,
+			gas_species=gas_species
+		)
+
+
+def gas_species_from_keywords(dobj_url: str, keywords: Optional[list[str]]) -> str:
+	"""Determine the gas species covered by a data object from its specification's keywords."""
+
+	prefix_msg = f"The gas species covered by data object {dobj_url} cannot be determined"
+	if keywords is None:
+		raise ValueError(f"{prefix_msg} for lack of keyword.")
+	dobj_gas_species = set(keywords).intersection(WDCGG_GAS_SPECIES_CODES.keys())
+	if len(dobj_gas_species) == 0:
+		raise ValueError(f"{prefix_msg} because none of 'CO2', 'CH4', 'N2O' and 'CO' appear in the keywords.")
+	elif len(dobj_gas_species) == 1:
+		return list(dobj_gas_species)[0]
+	else:
+		raise ValueError(f"{prefix_msg} because more than one gas species were found in the keywords.")
+
+
+def record_field(record: Any, name: str) -> Any:
+	"""Field of a record, or of its dictionary form restored from a run manifest."""
+
+	return record[name] if isinstance(record, dict) else getattr(record, name)
+
+
 def timestamp_to_str(timestamp: float, fmt: str) -> str:
 	return datetime.fromtimestamp(timestamp).strftime(fmt)
\ No newline at end of file